@@ -0,0 +1,190 @@
+# Import necessary libraries
+import os
+import time
+import bisect
+import logging
+import ipaddress
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Disable certificate warnings
+import urllib3
+urllib3.disable_warnings()
+
+# Aviatrix controller API client shared by the examples.  The Lambda archives package this file next to the function,
+# the scripts in this repository import it from the repository root.
+
+# Controller API client - one pooled keep-alive session and a cached CID, both reused across warm Lambda invocations
+CID_TTL = int(os.getenv("AVIATRIX_CID_TTL", "1800"))
+CONTROLLER_MAX_IN_FLIGHT = int(os.getenv("CONTROLLER_MAX_IN_FLIGHT", "8"))
+controller_session = None
+cid_cache = {}
+
+def get_controller_session():
+    global controller_session
+    if controller_session is None:
+        controller_session = requests.Session()
+        # Retry rate limited and transient controller errors with exponential backoff, honoring Retry-After.
+        # POST is not retried as it may create objects
+        retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                        allowed_methods=["GET", "PUT", "DELETE"], raise_on_status=False)
+        controller_session.mount("https://", HTTPAdapter(pool_maxsize=max(10, CONTROLLER_MAX_IN_FLIGHT), max_retries=retries))
+        # Drop the cached CID when the controller rejects it so the next login fetches a new one
+        controller_session.hooks['response'].append(expire_cid_on_auth_error)
+    return controller_session
+
+def expire_cid_on_auth_error(response, *args, **kwargs):
+    if response.status_code in (401, 403):
+        cid_cache.clear()
+
+# Function to login to the controller
+def login(controller_ip, controller_user, controller_password):
+    # URL for the controller API
+    url = "https://{}/v2/api".format(controller_ip)
+    # Payload to send for login
+    payload = {'action': 'login',
+               'username': controller_user,
+               'password': controller_password}
+
+    headers = {}
+
+    # Reuse the CID from a previous login until it expires
+    cached = cid_cache.get(controller_ip)
+    if cached and cached["expires"] > time.time():
+        return cached["cid"]
+
+    # Make a POST request to the URL with the payload
+    response = get_controller_session().post(url, headers=headers, data=payload, verify=False)
+
+    # Cache and return the CID from the response
+    cid = response.json()["CID"]
+    cid_cache[controller_ip] = {"cid": cid, "expires": time.time() + CID_TTL}
+    return cid
+
+# Concurrent SmartGroup updates - at most CONTROLLER_MAX_IN_FLIGHT requests in flight, paced by a token bucket of
+# CONTROLLER_RATE_LIMIT requests per second with bursts of up to CONTROLLER_BURST.  A rate limit of 0 disables pacing.
+CONTROLLER_RATE_LIMIT = float(os.getenv("CONTROLLER_RATE_LIMIT", "10"))
+CONTROLLER_BURST = int(os.getenv("CONTROLLER_BURST", "5"))
+rate_limit_lock = threading.Lock()
+rate_limit_bucket = {"tokens": CONTROLLER_BURST, "updated": time.monotonic()}
+
+# Block until the token bucket allows another controller request
+def acquire_controller_token():
+    if CONTROLLER_RATE_LIMIT <= 0:
+        return
+    while True:
+        with rate_limit_lock:
+            now = time.monotonic()
+            rate_limit_bucket["tokens"] = min(CONTROLLER_BURST, rate_limit_bucket["tokens"] +
+                                              (now - rate_limit_bucket["updated"]) * CONTROLLER_RATE_LIMIT)
+            rate_limit_bucket["updated"] = now
+            if rate_limit_bucket["tokens"] >= 1:
+                rate_limit_bucket["tokens"] -= 1
+                return
+            wait = (1 - rate_limit_bucket["tokens"]) / CONTROLLER_RATE_LIMIT
+        time.sleep(wait)
+
+# Run update for every item concurrently.  Results are returned in the order of the items and a failed update does not stop the others.
+def run_concurrent_updates(update, items):
+    def run(item):
+        try:
+            return update(item)
+        except Exception as e:
+            logging.error("SmartGroup update failed: {}".format(e))
+            return {"result": "Failed {}".format(e), "status": "failed"}
+
+    with ThreadPoolExecutor(max_workers=max(1, CONTROLLER_MAX_IN_FLIGHT)) as executor:
+        return list(executor.map(run, items))
+
+# App-domains snapshot - the SmartGroup listing indexed by UUID and by name, reused across warm Lambda invocations for
+# APP_DOMAINS_TTL seconds and dropped whenever this process writes a SmartGroup.  Keep the TTL short, changes made by
+# others are only seen once the snapshot expires.  Updates that rewrite a SmartGroup from its current selector ask for
+# a fresh snapshot so they never start from a stale one.
+APP_DOMAINS_TTL = int(os.getenv("APP_DOMAINS_TTL", "30"))
+app_domains_cache = {}
+
+def get_app_domains(controller_ip, cid, fresh=False):
+    cached = app_domains_cache.get(controller_ip)
+    if cached and cached["expires"] > time.time() and not fresh:
+        return cached
+
+    # Parameters to send for the GET request
+    headers = {
+        "Authorization": "cid {}".format(cid)
+    }
+
+    # Make a GET request to get current SmartGroups
+    response = get_controller_session().get("https://{}/v2.5/api/app-domains".format(
+        controller_ip), headers=headers, verify=False)
+    logging.debug("Response for Existing SmartGroups: {} {}".format(response.status_code, len(response.content)))
+    app_domains = response.json()['app_domains']
+
+    snapshot = {
+        "app_domains": app_domains,
+        "by_uuid": {x["uuid"]: x for x in app_domains},
+        # Sorted (name, uuid) pairs, the SmartGroups sharing a name prefix are one contiguous slice
+        "by_name": sorted([(x["name"], x["uuid"]) for x in app_domains]),
+        "expires": time.time() + APP_DOMAINS_TTL
+    }
+    app_domains_cache[controller_ip] = snapshot
+    return snapshot
+
+# Return the SmartGroups whose name starts with prefix
+def get_app_domains_by_prefix(snapshot, prefix):
+    start = bisect.bisect_left(snapshot["by_name"], (prefix,))
+    smartgroups = []
+    for name, uuid in snapshot["by_name"][start:]:
+        if not name.startswith(prefix):
+            break
+        smartgroups.append(snapshot["by_uuid"][uuid])
+    return smartgroups
+
+def invalidate_app_domains(controller_ip):
+    app_domains_cache.pop(controller_ip, None)
+
+# Return the CIDRs of a SmartGroup selector, or None when the selector also matches on something other than a CIDR
+def get_selector_cidrs(smartgroup):
+    cidrs = []
+    for x in smartgroup.get("selector", {}).get("any", []):
+        if list(x.get("all", {}).keys()) != ["cidr"]:
+            return None
+        cidrs.append(x["all"]["cidr"])
+    return cidrs
+
+# Collapse a list of addresses/CIDRs into the smallest equivalent list of CIDRs.  Host routes are kept as plain addresses.
+def aggregate_cidrs(cidrs):
+    networks = [ipaddress.ip_network(x, strict=False) for x in cidrs]
+    aggregated = []
+    for version in (4, 6):
+        aggregated += ipaddress.collapse_addresses([x for x in networks if x.version == version])
+    return [str(x.network_address) if x.num_addresses == 1 else str(x) for x in aggregated]
+
+# Remove addresses/CIDRs from a list of CIDRs.  Removing part of an aggregated CIDR keeps the rest of its range.
+def remove_cidrs(current_cidrs, cidrs):
+    remaining = [ipaddress.ip_network(x, strict=False) for x in current_cidrs]
+    for removed in [ipaddress.ip_network(x, strict=False) for x in cidrs]:
+        next_remaining = []
+        for network in remaining:
+            if network.version != removed.version or not network.overlaps(removed):
+                next_remaining.append(network)
+            elif network != removed and removed.subnet_of(network):
+                next_remaining += network.address_exclude(removed)
+        remaining = next_remaining
+    return aggregate_cidrs(remaining)
+
+# Compare two lists of CIDRs as address sets, ignoring order, duplicates, /32 suffixes and how the ranges are split
+def same_cidrs(current, new):
+    if current is None:
+        return False
+    try:
+        return aggregate_cidrs(current) == aggregate_cidrs(new)
+    except (ValueError, TypeError):
+        return False
+
+# Count the per group results by status for the handler response
+def summarize_results(updated_groups):
+    return {status: len([x for x in updated_groups if x["status"] == status])
+            for status in ["changed", "unchanged", "created", "failed"]}
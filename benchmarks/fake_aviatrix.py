@@ -0,0 +1,313 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timezone
+import threading
+import subprocess
+import tempfile
+import argparse
+import socket
+import json
+import time
+import uuid
+import ssl
+import os
+
+# Local stand-in for the Aviatrix controller and CoPilot APIs used by the examples, for benchmarks.
+#
+# Controller:  POST /v2/api (login), GET/POST /v2.5/api/app-domains, PUT /v2.5/api/app-domains/<uuid>,
+#              GET/PUT /v2.5/api/microseg/policy-list
+# CoPilot:     POST /api/login, GET /api/logout, POST /api/microseg/policies/logs[/count]
+#
+# The app-domains listing holds an equal number of CIDR SmartGroups ("sg_<i>"), FQDN SmartGroups
+# ("fqdn_host<i>_bench_example_com") and WebGroups ("wg_<i>"), and the policy list has one rule per CIDR SmartGroup.
+# Logs are generated on the fly from their index, newest first, so any volume can be served without holding it.
+# When dnspython is installed a DNS server answers A queries for the FQDN SmartGroups.
+#
+# HTTPS uses a throwaway self-signed certificate, the scripts do not verify controller or CoPilot certificates.
+#
+# python3 fake_aviatrix.py --port 8443 --logs 1000000 --smartgroups 1000 --latency 0.01
+
+INTERNET_SMARTGROUP_ID = "def000ad-0000-0000-0000-000000000001"
+BENCHMARK_CID = "benchmark-cid"
+BENCHMARK_NAMESPACE = uuid.UUID("6f1e1d1c-0b0a-4000-8000-000000000000")
+
+# Pools the synthetic logs draw from, the same shape as benchmark_processors.synthetic_dcf_logs
+LOG_SERVICE_PORTS = [22, 53, 80, 443, 8443]
+LOG_DESTINATIONS = 50000
+LOG_HOSTNAMES = 5000
+
+
+def smartgroup_uuid(name):
+    return str(uuid.uuid5(BENCHMARK_NAMESPACE, name))
+
+def fqdn_smartgroup_name(i):
+    return "fqdn_host{}_bench_example_com".format(i)
+
+def fqdn_smartgroup_ip(i):
+    return "100.64.{}.{}".format((i >> 8) & 255, i & 255)
+
+# Split a SmartGroup count between the three kinds, at least one of each
+def smartgroup_counts(smartgroups):
+    count = max(1, smartgroups // 3)
+    return count, count, count
+
+def build_app_domains(smartgroups):
+    cidr_groups, fqdn_groups, web_groups = smartgroup_counts(smartgroups)
+    app_domains = []
+    for i in range(cidr_groups):
+        name = "sg_{}".format(i)
+        app_domains.append({"uuid": smartgroup_uuid(name), "name": name, "system_resource": False,
+                            "selector": {"any": [{"all": {"cidr": "10.{}.{}.0/24".format((i >> 8) & 255, i & 255)}}]}})
+    for i in range(fqdn_groups):
+        name = fqdn_smartgroup_name(i)
+        # Every other FQDN SmartGroup is out of date so the resolver has updates to make
+        ip = fqdn_smartgroup_ip(i) if i % 2 == 0 else "192.0.2.1"
+        app_domains.append({"uuid": smartgroup_uuid(name), "name": name, "system_resource": False,
+                            "selector": {"any": [{"all": {"cidr": ip}}]}})
+    for i in range(web_groups):
+        name = "wg_{}".format(i)
+        app_domains.append({"uuid": smartgroup_uuid(name), "name": name, "system_resource": False,
+                            "selector": {"any": [{"all": {"snifilter": "*.tenant{}.example.com".format(i)}}]}})
+    return app_domains
+
+def build_policies(smartgroups):
+    cidr_groups = smartgroup_counts(smartgroups)[0]
+    policies = []
+    for i in range(cidr_groups):
+        name = "sg_{}".format(i)
+        policies.append({"uuid": smartgroup_uuid("rule_{}".format(i)), "name": "rule_{}".format(i),
+                         "priority": 100 + i, "action": "PERMIT", "protocol": "TCP", "logging": True,
+                         "watch": False, "src_ads": [smartgroup_uuid(name)], "dst_ads": [INTERNET_SMARTGROUP_ID],
+                         "port_ranges": [{"lo": 443, "hi": 443}], "web_filters": []})
+    return policies
+
+# Synthetic DCF log i, in the format CoPilot returns
+def build_log(i, timestamp, policy_uuid):
+    h = (i * 2654435761) & 0xffffffff
+    mitm = h & 1
+    reverse = not mitm and (h >> 1) & 1
+    service = LOG_SERVICE_PORTS[(h >> 2) % len(LOG_SERVICE_PORTS)]
+    ephemeral = 32768 + (h >> 5) % 28232
+    destination = (h >> 7) % LOG_DESTINATIONS
+    source_ip = "10.1.{}.{}".format((h >> 11) & 15, (h >> 15) & 255)
+    destination_ip = "52.{}.{}.{}".format(destination >> 16, (destination >> 8) & 255, destination & 255)
+    hostname = (h >> 9) % LOG_HOSTNAMES
+    return {
+        "id": str(i),
+        "timestamp": datetime.fromtimestamp(timestamp/1000, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+        "policyUuid": policy_uuid,
+        "sourceIp": destination_ip if reverse else source_ip,
+        "destinationIp": source_ip if reverse else destination_ip,
+        "protocol": "UDP" if service == 53 else "TCP",
+        "sourcePort": service if reverse else ephemeral,
+        "destinationPort": ephemeral if reverse else service,
+        "gatewayHostname": "bench-spoke",
+        "action": "PERMIT",
+        "isEnforced": True,
+        "tags": ["mitm", "microseg"] if mitm else ["ebpf", "microseg"],
+        "mitmSniHostname": "h{}.tenant{}.example.com".format(hostname % 500, hostname // 500) if mitm else None,
+        "_searchAfter": [timestamp],
+    }
+
+def parse_timestamp(value):
+    value = value.replace('Z', '+00:00')
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp()*1000)
+
+
+class FakeAviatrix:
+    def __init__(self, logs=10000, smartgroups=30, latency=0.0, log_window_hours=12):
+        self.lock = threading.Lock()
+        self.latency = latency
+        self.app_domains = build_app_domains(smartgroups)
+        self.policies = build_policies(smartgroups)
+        self.requests = {}
+        # Log i has the timestamp end - i*step, newest first
+        self.logs = logs
+        self.log_end = int(time.time()*1000)
+        self.log_step = max(1, int(log_window_hours*60*60*1000) // max(1, logs))
+        self.log_policy_uuid = self.policies[0]["uuid"]
+
+    def count_request(self, method, path):
+        key = "{} {}".format(method, path.split('?')[0].rstrip('/'))
+        with self.lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    # Index range [first, last) of the logs matching a CoPilot log query
+    def log_range(self, payload):
+        first, last = 0, self.logs
+        for item in payload.get("filterModel", {}).get("items", []):
+            if item["field"] == "policyUuid" and self.log_policy_uuid not in item["value"]:
+                return 0, 0
+            if item["field"] == "timestamp" and item["operator"] == "after":
+                last = min(last, (self.log_end - parse_timestamp(item["value"])) // self.log_step + 1)
+            if item["field"] == "timestamp" and item["operator"] == "before":
+                first = max(first, (self.log_end - parse_timestamp(item["value"])) // self.log_step + 1)
+        search_after = payload.get("searchAfter")
+        if search_after:
+            first = max(first, (self.log_end - search_after[0]) // self.log_step + 1)
+        return max(0, first), max(0, last)
+
+    def get_log_count(self, payload):
+        first, last = self.log_range(payload)
+        return {"total": max(0, last - first)}
+
+    def get_logs(self, payload):
+        first, last = self.log_range(payload)
+        last = min(last, first + int(payload.get("size", 100)))
+        return {"items": [build_log(i, self.log_end - i*self.log_step, self.log_policy_uuid)
+                          for i in range(first, last)]}
+
+    def put_app_domain(self, smartgroup_uuid, body):
+        with self.lock:
+            for smartgroup in self.app_domains:
+                if smartgroup["uuid"] == smartgroup_uuid:
+                    smartgroup.update({"name": body.get("name", smartgroup["name"]),
+                                       "selector": body.get("selector", smartgroup["selector"])})
+                    return 200, {"return": True, "uuid": smartgroup_uuid}
+        return 404, {"return": False, "reason": "SmartGroup {} not found".format(smartgroup_uuid)}
+
+    def create_app_domain(self, body):
+        smartgroup = {"uuid": str(uuid.uuid4()), "name": body["name"], "system_resource": False,
+                      "selector": body.get("selector", {"any": []})}
+        with self.lock:
+            self.app_domains.append(smartgroup)
+        return 200, {"return": True, "uuid": smartgroup["uuid"]}
+
+    def handle(self, method, path, body):
+        self.count_request(method, path)
+        if self.latency > 0:
+            time.sleep(self.latency)
+        path = path.split('?')[0].rstrip('/')
+        if method == "POST" and path == "/v2/api":
+            return 200, {"return": True, "CID": BENCHMARK_CID}
+        if method == "POST" and path == "/api/login":
+            return 200, {"status": "ok"}
+        if method == "GET" and path == "/api/logout":
+            return 200, {"status": "ok"}
+        if method == "POST" and path == "/api/microseg/policies/logs/count":
+            return 200, self.get_log_count(json.loads(body))
+        if method == "POST" and path == "/api/microseg/policies/logs":
+            return 200, self.get_logs(json.loads(body))
+        if path == "/v2.5/api/app-domains":
+            if method == "GET":
+                with self.lock:
+                    return 200, {"app_domains": json.loads(json.dumps(self.app_domains))}
+            if method == "POST":
+                return self.create_app_domain(json.loads(body))
+        if method == "PUT" and path.startswith("/v2.5/api/app-domains/"):
+            return self.put_app_domain(path.rsplit('/', 1)[1], json.loads(body))
+        if path == "/v2.5/api/microseg/policy-list":
+            if method == "GET":
+                with self.lock:
+                    return 200, {"policies": json.loads(json.dumps(self.policies))}
+            if method == "PUT":
+                with self.lock:
+                    self.policies = json.loads(body)["policies"]
+                return 200, {"return": True}
+        return 404, {"return": False, "reason": "Not found"}
+
+
+def make_request_handler(fake):
+    class RequestHandler(BaseHTTPRequestHandler):
+        # Keep-alive, the scripts reuse pooled connections
+        protocol_version = "HTTP/1.1"
+
+        def respond(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            status, payload = fake.handle(self.command, self.path, body)
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = respond
+        do_POST = respond
+        do_PUT = respond
+        do_DELETE = respond
+
+        def log_message(self, format, *args):
+            pass
+    return RequestHandler
+
+# Self-signed certificate for localhost, written to directory
+def create_certificate(directory):
+    certfile = os.path.join(directory, "fake_aviatrix.crt")
+    keyfile = os.path.join(directory, "fake_aviatrix.key")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost",
+                    "-keyout", keyfile, "-out", certfile], check=True, capture_output=True)
+    return certfile, keyfile
+
+def start_https_server(fake, port=0, certfile=None, keyfile=None):
+    if certfile is None:
+        certfile, keyfile = create_certificate(tempfile.mkdtemp())
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_request_handler(fake))
+    server.daemon_threads = True
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Answer A queries for host<i>.bench.example.com with fqdn_smartgroup_ip(i), anything else is NXDOMAIN
+def start_dns_server(fake, port=0):
+    import dns.message
+    import dns.rcode
+    import dns.rrset
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", port))
+
+    def answer(data, address):
+        if fake.latency > 0:
+            time.sleep(fake.latency)
+        query = dns.message.from_wire(data)
+        response = dns.message.make_response(query)
+        question = query.question[0]
+        labels = question.name.to_text().split('.')
+        if labels[0].startswith("host") and labels[0][4:].isdigit() and labels[1:4] == ["bench", "example", "com"]:
+            response.answer.append(dns.rrset.from_text(question.name, 300, "IN", "A",
+                                                       fqdn_smartgroup_ip(int(labels[0][4:]))))
+        else:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        sock.sendto(response.to_wire(), address)
+
+    def serve():
+        while True:
+            data, address = sock.recvfrom(4096)
+            threading.Thread(target=answer, args=(data, address), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return sock.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Aviatrix Controller and CoPilot')
+    parser.add_argument('--port', type=int, help='HTTPS port, 0 for any free port', default=8443)
+    parser.add_argument('--dns_port', type=int, help='DNS port, 0 for any free port, -1 to disable', default=-1)
+    parser.add_argument('--logs', type=int, help='Number of DCF logs served', default=10000)
+    parser.add_argument('--log_window_hours', type=float, help='Time window the logs are spread over', default=12)
+    parser.add_argument('--smartgroups', type=int, help='Number of SmartGroups and WebGroups served', default=30)
+    parser.add_argument('--latency', type=float, help='Added latency per request in seconds', default=0.0)
+    parser.add_argument('--certfile', type=str, help='TLS certificate, a self-signed one is created by default')
+    parser.add_argument('--keyfile', type=str, help='TLS private key')
+    args = parser.parse_args()
+
+    fake = FakeAviatrix(logs=args.logs, smartgroups=args.smartgroups, latency=args.latency,
+                        log_window_hours=args.log_window_hours)
+    server = start_https_server(fake, args.port, args.certfile, args.keyfile)
+    dns_port = start_dns_server(fake, args.dns_port) if args.dns_port >= 0 else None
+    # The first line of output tells a parent process where the servers listen
+    print(json.dumps({"port": server.server_address[1], "dns_port": dns_port}), flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
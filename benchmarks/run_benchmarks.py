@@ -0,0 +1,325 @@
+from contextlib import redirect_stdout
+from time import perf_counter
+import importlib.util
+import subprocess
+import tempfile
+import argparse
+import resource
+import json
+import sys
+import os
+
+import fake_aviatrix
+
+# End to end benchmarks of DCF log fetching, the recommendation processors and the Lambda handlers, run against
+# fake_aviatrix.py.  Every measurement runs in a fresh process with its own fake controller and CoPilot, and reports
+# wall time, throughput and the peak resident memory of the measured call.  Logs are scaled with --logs and the
+# SmartGroup, WebGroup and rule counts with --smartgroups.
+#
+# python3 run_benchmarks.py --logs 1000 100000 10000000 --smartgroups 10 1000 10000 --latency 0.005
+# python3 run_benchmarks.py --output baseline.json
+# python3 run_benchmarks.py --compare baseline.json --tolerance 0.25
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Scenarios scaled by the number of logs
+LOG_SCENARIOS = ["get_dcf_logs", "process_dcf_logs", "sketch_dcf_logs"]
+# Scenarios scaled by the number of SmartGroups, with the Lambda handler each one calls
+HANDLER_SCENARIOS = {
+    "update_smart_group": "update_smart_group/example.py",
+    "update_web_group": "update_web_group/example.py",
+    "update_dcf_ruleset": "update_dcf_ruleset/example.py",
+    "non_web_fqdn_resolver": "non_web_fqdn_resolver/lambda_function/function.py",
+    "edl_github": "edl_github/lambda_function/function.py",
+}
+SCENARIOS = LOG_SCENARIOS + list(HANDLER_SCENARIOS)
+# Synthetic logs are built and normalized in chunks, so building them costs less memory than processing them
+SYNTHETIC_CHUNK_ROWS = 250000
+# Differences below these are noise at small scales and never count as regressions
+MIN_SECONDS_REGRESSION = 0.25
+MIN_PEAK_MB_REGRESSION = 10
+
+
+# Resident memory of this process in MB, current and peak.  The peak is read from /proc so it can be reset before
+# the measured call, elsewhere it is the peak of the whole process.
+def read_rss():
+    try:
+        with open("/proc/self/status") as f:
+            status = dict(line.split(":", 1) for line in f)
+        return int(status["VmRSS"].split()[0]) / 1024, int(status["VmHWM"].split()[0]) / 1024
+    except (OSError, KeyError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+        return peak, peak
+
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+# Time function and record the memory it added on top of what was resident before the call
+def measure(function, items):
+    reset_peak_rss()
+    rss_before, _ = read_rss()
+    start = perf_counter()
+    ok = function()
+    seconds = perf_counter() - start
+    _, peak = read_rss()
+    return {"seconds": seconds, "items": items, "items_per_second": items / seconds if seconds else None,
+            "rss_before_mb": rss_before, "peak_mb": peak, "peak_delta_mb": max(0, peak - rss_before), "ok": ok}
+
+
+# Child benchmarks - each runs in its own process and prints its measurement as JSON
+
+def import_epr():
+    sys.path.insert(0, os.path.join(REPO, "egress_policy_recommendation"))
+    import egress_policy_recommendation
+    return egress_policy_recommendation
+
+def bench_get_dcf_logs(args, host):
+    epr = import_epr()
+    cid = epr.controller_login(host, "benchmark", "benchmark")
+    policy_uuids = epr.get_internet_policy_uuids(host, cid, 0)
+    s = epr.copilot_login("benchmark", "benchmark", host)
+    result = {}
+
+    # Fetch an hour beyond the log window, the server spread the logs over the window before this process started
+    def fetch():
+        result["df"] = epr.get_dcf_logs(s, host, (args.log_window_hours + 1) / 24, policy_uuids, 0, workers=args.workers,
+                                        page_size=args.page_size)
+        return len(result["df"]) == args.scale
+    return measure(fetch, args.scale)
+
+# Normalized synthetic logs with the same fields and value formats as CoPilot returns
+def build_normalized_logs(epr, rows):
+    sys.path.insert(0, os.path.join(REPO, "egress_policy_recommendation"))
+    from benchmark_processors import synthetic_dcf_logs
+    import pandas as pd
+    chunks = []
+    for seed, start in enumerate(range(0, rows, SYNTHETIC_CHUNK_ROWS)):
+        chunks.append(epr.normalize_dcf_logs(synthetic_dcf_logs(min(SYNTHETIC_CHUNK_ROWS, rows - start), seed)))
+    return pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+
+def bench_process_dcf_logs(args, host):
+    epr = import_epr()
+    df = build_normalized_logs(epr, args.scale)
+    return measure(lambda: all(x is not None for x in epr.process_dcf_logs(df)), args.scale)
+
+def bench_sketch_dcf_logs(args, host):
+    epr = import_epr()
+    df = build_normalized_logs(epr, args.scale)
+    return measure(lambda: epr.sketch_dcf_logs(df) is not None, args.scale)
+
+# Import a Lambda handler module.  The examples call their handler with a test event on import, that output is dropped.
+def import_handler(scenario):
+    spec = importlib.util.spec_from_file_location("benchmark_" + scenario,
+                                                  os.path.join(REPO, HANDLER_SCENARIOS[scenario]))
+    module = importlib.util.module_from_spec(spec)
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        spec.loader.exec_module(module)
+    # Start from a cold CID and app-domains cache, as after a Lambda cold start
+    for owner in (module, sys.modules.get("aviatrix_client")):
+        for cache in ("cid_cache", "app_domains_cache"):
+            if hasattr(owner, cache):
+                getattr(owner, cache).clear()
+    return module
+
+# Call a handler and check that none of its controller writes failed
+def call_handler(module, event):
+    response = module.handler(event, None)
+    return response["statusCode"] == 200 and '"status": "failed"' not in response["body"] and \
+        "Failed" not in response["body"] and "Invalid" not in response["body"]
+
+def bench_update_smart_group(args, host):
+    module = import_handler("update_smart_group")
+    cidr_groups = fake_aviatrix.smartgroup_counts(args.scale)[0]
+    operations = [{"smartgroup_uuid": fake_aviatrix.smartgroup_uuid("sg_{}".format(i)), "action": "ADD",
+                   "domains": ["172.16.{}.{}".format((i >> 8) & 255, i & 255)]} for i in range(cidr_groups)]
+    event = {"body": json.dumps({"operations": operations})}
+    return measure(lambda: call_handler(module, event), len(operations))
+
+def bench_update_web_group(args, host):
+    module = import_handler("update_web_group")
+    web_groups = fake_aviatrix.smartgroup_counts(args.scale)[2]
+    operations = [{"smartgroup_uuid": fake_aviatrix.smartgroup_uuid("wg_{}".format(i)), "action": "ADD",
+                   "domains": ["bench{}.example.org".format(i)]} for i in range(web_groups)]
+    event = {"body": json.dumps({"operations": operations})}
+    return measure(lambda: call_handler(module, event), len(operations))
+
+# Replace every rule of the policy list, deleting it and adding a copy at a new priority
+def bench_update_dcf_ruleset(args, host):
+    module = import_handler("update_dcf_ruleset")
+    policies = fake_aviatrix.build_policies(args.scale)
+    operations = []
+    for index, policy in enumerate(policies):
+        rule = dict(policy, name="{}_moved".format(policy["name"]), priority=100000 + index)
+        del rule["uuid"]
+        operations.append({"action": "DELETE_RULE", "rule_uuid": policy["uuid"]})
+        operations.append({"action": "ADD_RULE", "rule": rule})
+    event = {"body": json.dumps({"action": "EDIT_RULES", "operations": operations})}
+    return measure(lambda: call_handler(module, event), len(operations))
+
+# Resolve every FQDN SmartGroup against the fake DNS server in place of the system resolvers
+def bench_non_web_fqdn_resolver(args, host):
+    import dns.asyncresolver
+    resolver_class = dns.asyncresolver.Resolver
+
+    class BenchmarkResolver(resolver_class):
+        def __init__(self, *resolver_args, **kwargs):
+            super().__init__(configure=False)
+            self.nameservers = ["127.0.0.1"]
+            self.port = args.dns_port
+
+    dns.asyncresolver.Resolver = BenchmarkResolver
+    module = import_handler("non_web_fqdn_resolver")
+    return measure(lambda: call_handler(module, None), fake_aviatrix.smartgroup_counts(args.scale)[1])
+
+# Sync a local text list of one address per SmartGroup into its external SmartGroup
+def bench_edl_github(args, host):
+    directory = tempfile.mkdtemp()
+    warmup = os.path.join(directory, "warmup.txt")
+    addresses = os.path.join(directory, "addresses.txt")
+    with open(warmup, "w") as f:
+        f.write("192.0.2.0/24\n")
+    with open(addresses, "w") as f:
+        for i in range(args.scale):
+            f.write("198.{}.{}.{}/32\n".format(18 + ((i >> 16) & 1), (i >> 8) & 255, i & 255))
+    # The import-time test call syncs the warmup list, the measured call syncs a list not seen before
+    os.environ["EDL_CACHE"] = os.path.join(directory, "edl_cache.json")
+    os.environ["EDL_SOURCES"] = json.dumps([{"source": "warmup", "type": "text", "path": warmup, "name": "list"}])
+    module = import_handler("edl_github")
+    os.environ["EDL_SOURCES"] = json.dumps([{"source": "bench", "type": "text", "path": addresses, "name": "list"}])
+    return measure(lambda: call_handler(module, None), args.scale)
+
+def run_child(args):
+    host = "127.0.0.1:{}".format(args.port)
+    for name in ("CONTROLLER_IP", "AVIATRIX_CONTROLLER_IP"):
+        os.environ[name] = host
+    for name in ("CONTROLLER_USER", "CONTROLLER_PASSWORD", "AVIATRIX_USERNAME", "AVIATRIX_PASSWORD"):
+        os.environ[name] = "benchmark"
+    os.environ["CONTROLLER_RATE_LIMIT"] = str(args.controller_rate_limit)
+    os.environ["CONTROLLER_MAX_IN_FLIGHT"] = str(args.controller_max_in_flight)
+    os.environ["POLICY_WRITE_SETTLE"] = "0"
+    result = globals()["bench_" + args.child](args, host)
+    print(json.dumps(result), flush=True)
+
+
+# Parent - start a fake controller and CoPilot per measurement and run the child benchmark against it
+
+def start_fake_aviatrix(args, logs, smartgroups, certfile, keyfile):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_aviatrix.py"),
+               "--port", "0", "--dns_port", "0", "--logs", str(logs), "--smartgroups", str(smartgroups),
+               "--latency", str(args.latency), "--log_window_hours", str(args.log_window_hours),
+               "--certfile", certfile, "--keyfile", keyfile]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    ports = json.loads(server.stdout.readline())
+    return server, ports
+
+def run_benchmark(args, scenario, scale, certfile, keyfile):
+    logs, smartgroups = (scale, 10) if scenario in LOG_SCENARIOS else (10, scale)
+    server, ports = None, {"port": 0, "dns_port": 0}
+    if scenario not in ("process_dcf_logs", "sketch_dcf_logs"):
+        server, ports = start_fake_aviatrix(args, logs, smartgroups, certfile, keyfile)
+    try:
+        command = [sys.executable, os.path.abspath(__file__), "--child", scenario, "--scale", str(scale),
+                   "--port", str(ports["port"]), "--dns_port", str(ports["dns_port"] or 0),
+                   "--latency", str(args.latency), "--log_window_hours", str(args.log_window_hours),
+                   "--page_size", str(args.page_size), "--workers", str(args.workers),
+                   "--controller_rate_limit", str(args.controller_rate_limit),
+                   "--controller_max_in_flight", str(args.controller_max_in_flight)]
+        child = subprocess.run(command, capture_output=True, text=True, timeout=args.timeout)
+    except subprocess.TimeoutExpired:
+        return {"error": "timed out after {}s".format(args.timeout)}
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+    if child.returncode != 0:
+        return {"error": child.stderr.strip().splitlines()[-1] if child.stderr.strip() else
+                "exit code {}".format(child.returncode)}
+    return json.loads(child.stdout.strip().splitlines()[-1])
+
+# Compare results with a baseline run, returning the measurements that got slower or bigger by more than tolerance
+def find_regressions(results, baseline, tolerance):
+    previous = {(x["scenario"], x["scale"]): x for x in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get((result["scenario"], result["scale"]))
+        if before is None or "error" in before:
+            continue
+        if "error" in result:
+            regressions.append("{} {}: {}".format(result["scenario"], result["scale"], result["error"]))
+            continue
+        for key, minimum in (("seconds", MIN_SECONDS_REGRESSION), ("peak_delta_mb", MIN_PEAK_MB_REGRESSION)):
+            if result[key] > before[key] * (1 + tolerance) and result[key] - before[key] > minimum:
+                regressions.append("{} {}: {} {:.2f} -> {:.2f}".format(
+                    result["scenario"], result["scale"], key, before[key], result[key]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='DCF Automation Benchmarks')
+    parser.add_argument('--scenarios', type=str, nargs='+', choices=SCENARIOS, help='Benchmarks to run',
+                        default=SCENARIOS)
+    parser.add_argument('--logs', type=int, nargs='+', help='Log counts for the log benchmarks',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--smartgroups', type=int, nargs='+', help='SmartGroup counts for the handler benchmarks',
+                        default=[10, 100, 1000])
+    parser.add_argument('--latency', type=float, help='Added latency per request in seconds', default=0.0)
+    parser.add_argument('--log_window_hours', type=float, help='Time window the logs are spread over', default=12)
+    parser.add_argument('--page_size', type=int, help='Logs per CoPilot page', default=1000)
+    parser.add_argument('--workers', type=int, help='Parallel CoPilot log fetch workers', default=1)
+    parser.add_argument('--controller_rate_limit', type=float,
+                        help='Controller requests per second of the handlers, 0 for unlimited', default=0)
+    parser.add_argument('--controller_max_in_flight', type=int, help='Concurrent controller requests of the handlers',
+                        default=8)
+    parser.add_argument('--timeout', type=int, help='Seconds allowed per measurement', default=3600)
+    parser.add_argument('--output', type=str, help='Write the results to this JSON file')
+    parser.add_argument('--compare', type=str, help='Baseline results to compare with, exits 1 on a regression')
+    parser.add_argument('--tolerance', type=float, help='Allowed slowdown or memory growth over the baseline',
+                        default=0.25)
+    parser.add_argument('--child', type=str, choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument('--scale', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--dns_port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    directory = tempfile.mkdtemp()
+    certfile, keyfile = fake_aviatrix.create_certificate(directory)
+    results = []
+    print("{:<22} {:>10} {:>10} {:>14} {:>10} {:>10}".format(
+        'scenario', 'scale', 'seconds', 'items/s', 'peak_mb', 'delta_mb'))
+    for scenario in args.scenarios:
+        for scale in args.logs if scenario in LOG_SCENARIOS else args.smartgroups:
+            result = dict(scenario=scenario, scale=scale, **run_benchmark(args, scenario, scale, certfile, keyfile))
+            results.append(result)
+            if "error" in result:
+                print("{:<22} {:>10} ERROR {}".format(scenario, scale, result["error"]))
+                continue
+            print("{:<22} {:>10} {:>10.2f} {:>14.0f} {:>10.0f} {:>10.0f}{}".format(
+                scenario, scale, result["seconds"], result["items_per_second"] or 0, result["peak_mb"],
+                result["peak_delta_mb"], "" if result["ok"] else "  (check failed)"), flush=True)
+
+    run = {"settings": {"latency": args.latency, "page_size": args.page_size, "workers": args.workers,
+                        "controller_rate_limit": args.controller_rate_limit,
+                        "controller_max_in_flight": args.controller_max_in_flight},
+           "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(run, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION {}".format(regression))
+        if regressions:
+            sys.exit(1)
+        print("No regressions against {}".format(args.compare))
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
 ## Shell script to install the required pip dependencies for the lambda function "example.py"
+# Repository root holding the shared controller client
+REPO_ROOT="$(cd "$(dirname "$0")/.." && pwd)"
+
 # Set up a virtual environment
 cd lambda_function
 virtualenv venv
@@ -11,8 +14,14 @@ pip install requests
 mkdir lambda_package
 
 
-# Copy the function.py file to the lambda_package directory
+# Copy the function.py file and the shared controller client to the lambda_package directory
 cp function.py lambda_package
+cp "$REPO_ROOT/aviatrix_client.py" lambda_package
+
+# Copy the local cloud provider range files used by "cloud" EDL sources, if any
+if [ -d ranges ]; then
+  cp -r ranges lambda_package
+fi
 
 # Copy the installed packages and subdirectories to the lambda_package directory
 cp -r venv/lib/python3.10/site-packages/* lambda_package
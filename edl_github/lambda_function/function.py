@@ -1,92 +1,260 @@
 # Import necessary libraries
 import json
 import os
+import sys
 import requests
 import logging
+import io
+import re
+from concurrent.futures import ThreadPoolExecutor
+import ipaddress
+import socket
 
 # Disable certificate warnings
 import urllib3
 urllib3.disable_warnings()
 
+# Shared controller API client, packaged next to this file in Lambda archives
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from aviatrix_client import login, get_controller_session, acquire_controller_token, run_concurrent_updates, \
+    get_app_domains, get_app_domains_by_prefix, invalidate_app_domains, get_selector_cidrs, same_cidrs, summarize_results
+
 logging.basicConfig(level=logging.INFO)
 
 # Main event handler function
 def handler(event, context):
+    sources = get_edl_sources()
+
+    # Fetch every source concurrently, sources unchanged since their last successful sync are skipped
+    cache = load_edl_cache()
+    fetched = fetch_edl_sources(sources, cache)
+
+    failures = [{"result": "Failed to fetch {}: {}".format(source["source"], x["error"]), "status": "failed"}
+                for source, x in zip(sources, fetched) if x["error"]]
+    not_modified = [source["source"] for source, x in zip(sources, fetched) if x["lists"] is None and not x["error"]]
+
+    # Source, SmartGroup name and CIDRs of every list of the changed sources
+    updates = [(source["source"], get_edl_smartgroup_name(source["source"], name), cidrs)
+               for source, x in zip(sources, fetched) if x["lists"] for name, cidrs in x["lists"].items()]
+
+    # Skip the SmartGroup phase when no source has changed
+    if not updates:
+        logging.info("EDL sources not modified, skipping SmartGroup updates")
+        return format_response(dict(summarize_results(failures), results=failures, not_modified=not_modified))
+
     # Login to the controller and get the CID
     cid = login(os.getenv("AVIATRIX_CONTROLLER_IP"), os.getenv(
         "AVIATRIX_USERNAME"), os.getenv("AVIATRIX_PASSWORD"))
-    
-    github_endpoints = json.loads(os.getenv("GITHUB_ENDPOINTS"))
 
     # Log the cid
     logging.debug("CID: {}".format(cid))
 
-    github_ips = get_github_ips(github_endpoints)
-    github_smartgroups = get_github_smartgroups(os.getenv("AVIATRIX_CONTROLLER_IP"), cid)
+    # Index the current EDL SmartGroups by name
+    edl_smartgroups = {x["name"]: x for x in get_edl_smartgroups(os.getenv("AVIATRIX_CONTROLLER_IP"), cid)}
+
+    updated_groups = run_concurrent_updates(lambda x: update_edl_smartgroup_cidrs(
+        os.getenv("AVIATRIX_CONTROLLER_IP"), edl_smartgroups, x[1], x[2], cid), updates)
+
+    # Only remember the version of a source once all of its SmartGroups are in sync, so a failed update is retried on the next run
+    failed_sources = set([x[0] for x, result in zip(updates, updated_groups) if result["status"] == "failed"])
+    for source, x in zip(sources, fetched):
+        if x["lists"] and x["version"] and source["source"] not in failed_sources:
+            cache[source["source"]] = {"version": x["version"], "config": source}
+    save_edl_cache(cache)
 
-    updated_groups = []
-    for endpoint in github_endpoints:
-        updated_groups.append(update_github_smartgroup_cidrs(os.getenv("AVIATRIX_CONTROLLER_IP"), github_smartgroups, github_ips, endpoint, cid))
+    results = failures + updated_groups
+    return format_response(dict(summarize_results(results), results=results, not_modified=not_modified))
 
-    # Format and return the response
+# Format the Lambda response
+def format_response(body):
     response = {
         "statusCode": 200,
         "headers": {
             "Content-Type": "application/json"
         },
-        "body": json.dumps(updated_groups)
+        "body": json.dumps(body)
     }
 
     return response
 
-def login(controller_ip, controller_user, controller_password):
-    # URL for the controller API
-    url = "https://{}/v2/api".format(controller_ip)
-    # Payload to send for login
-    payload = {'action': 'login',
-               'username': controller_user,
-               'password': controller_password}
+# EDL sources - each source is read by an adapter that yields the raw address entries of one or more lists, and every
+# list is synced to the SmartGroup external_<source>_<name>.  EDL_SOURCES is a JSON list of sources, for example
+#   {"source": "github", "type": "json", "url": "https://api.github.com/meta", "lists": {"git": "git", "web": "web"}}
+#   {"source": "spamhaus", "type": "text", "url": "https://www.spamhaus.org/drop/drop.txt", "name": "drop"}
+#   {"source": "aws", "type": "cloud", "provider": "aws", "path": "ranges/ip-ranges.json", "lists": {"s3": "S3"}}
+# Local paths are relative to this file.  Without EDL_SOURCES the GitHub endpoints in GITHUB_ENDPOINTS are synced.
+GITHUB_META_URL = os.getenv("GITHUB_META_URL", "https://api.github.com/meta")
+EDL_FETCH_WORKERS = int(os.getenv("EDL_FETCH_WORKERS", "4"))
+EDL_FETCH_TIMEOUT = int(os.getenv("EDL_FETCH_TIMEOUT", "30"))
+
+# The version of each source at its last successful sync, an ETag or a local file fingerprint.  It is kept in /tmp,
+# which persists across warm Lambda invocations, so unchanged URLs are answered with a 304.
+EDL_CACHE = os.getenv("EDL_CACHE", "/tmp/edl_cache.json")
+
+# JSON paths of the address lists in the range files published by the cloud providers, filled in with the list value
+CLOUD_RANGE_PATHS = {
+    "aws": "prefixes[service={}].ip_prefix",
+    "azure": "values[name={}].properties.addressPrefixes",
+    "gcp": "prefixes[scope={}].ipv4Prefix",
+}
+
+def get_edl_sources():
+    sources = json.loads(os.getenv("EDL_SOURCES") or "[]")
+    if sources:
+        return sources
+    return [{"source": "github", "type": "json", "url": GITHUB_META_URL,
+             "lists": {x: x for x in json.loads(os.getenv("GITHUB_ENDPOINTS"))}}]
+
+def get_edl_smartgroup_name(source, name):
+    return "external_{}_{}".format(source, name)
+
+def load_edl_cache():
+    try:
+        with open(EDL_CACHE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_edl_cache(cache):
+    # Write to a temporary file first so an interrupted write never leaves a partial cache
+    with open(EDL_CACHE + ".tmp", "w") as f:
+        json.dump(cache, f)
+    os.replace(EDL_CACHE + ".tmp", EDL_CACHE)
+
+# Open a source as a text stream.  Returns the version of the source and the stream, or no stream when the source
+# still has the cached version.  URLs are fetched with If-None-Match and streamed rather than read into memory.
+def open_edl_source(source, cached_version):
+    if "path" in source:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), source["path"])
+        stat = os.stat(path)
+        version = "{}-{}".format(int(stat.st_mtime), stat.st_size)
+        if version == cached_version:
+            return version, None
+        return version, open(path, encoding="utf-8")
 
     headers = {}
+    if cached_version:
+        headers["If-None-Match"] = cached_version
+    response = requests.get(source["url"], headers=headers, stream=True, timeout=EDL_FETCH_TIMEOUT)
+    if response.status_code == 304:
+        response.close()
+        return cached_version, None
+    response.raise_for_status()
+    # Keep the raw stream open at end of body so the text wrapper can read through to EOF
+    response.raw.decode_content = True
+    response.raw.auto_close = False
+    return response.headers.get("ETag"), io.TextIOWrapper(response.raw, encoding=response.encoding or "utf-8")
 
-    # Make a POST request to the URL with the payload
-    response = requests.post(url, headers=headers, data=payload, verify=False)
+# Plain text lists with one address or CIDR per line.  Anything after the first token and comments after # or ; are ignored.
+def parse_text_list(stream, source):
+    def entries():
+        for line in stream:
+            line = line.split("#", 1)[0].split(";", 1)[0].split()
+            if line:
+                yield line[0]
+    return {source["name"]: entries()}
 
-    # Return the CID from the response
-    return response.json()["CID"]
+# JSON documents with a JSON path per list
+def parse_json_lists(stream, source):
+    document = json.load(stream)
+    return {name: select_json_path(document, path) for name, path in source["lists"].items()}
 
-def get_github_ips(github_endpoints):
-    # Make a GET request to get the Github IPs
-    response = requests.get("https://api.github.com/meta")
-    response = response.json()
+# Cloud provider range files, each list selects a service or tag of the provider's file
+def parse_cloud_ranges(stream, source):
+    document = json.load(stream)
+    path = CLOUD_RANGE_PATHS[source["provider"]]
+    return {name: select_json_path(document, path.format(value)) for name, value in source["lists"].items()}
 
-    #filter out the response to only include the requested keys in github_endpoints variable
-    response = {key: response[key] for key in github_endpoints}
-    return response
+EDL_ADAPTERS = {
+    "text": parse_text_list,
+    "json": parse_json_lists,
+    "cloud": parse_cloud_ranges,
+}
 
-def filter_only_ipv4(ip_list):
-    # Filter out only the IPv4 addresses
-    return [x for x in ip_list if ":" not in x]
+# Yield the values at a dotted JSON path such as "prefixes[service=S3].ip_prefix".  Lists are walked into and a
+# [field=value] filter keeps the items whose field equals the value.
+def select_json_path(node, path):
+    if isinstance(node, list):
+        for x in node:
+            yield from select_json_path(x, path)
+        return
+    if not path:
+        yield node
+        return
+    key, condition, rest = re.match(r"([^.\[]*)(?:\[([^\]]*)\])?\.?(.*)", path).groups()
+    if not isinstance(node, dict) or key not in node:
+        return
+    node = node[key]
+    if condition:
+        field, _, value = condition.partition("=")
+        node = [x for x in (node if isinstance(node, list) else [node])
+                if isinstance(x, dict) and str(x.get(field)) == value]
+    yield from select_json_path(node, rest)
 
-def get_github_smartgroups(controller_ip, cid):
-    # URL for the controller API
-    url = "https://{}/v2.5/api".format(controller_ip)
-    # Parameters to send for the GET request
-    headers = {
-        "Authorization": "cid {}".format(cid)
-    }
+# Normalize the raw entries of a list into deduplicated IPv4 address ranges and collapse them into CIDRs.  Ranges are
+# kept as integer pairs rather than ipaddress objects so large lists stay fast and small.  IPv6 and invalid entries are skipped.
+def normalize_edl_entries(entries):
+    ranges = set()
+    invalid = 0
+    for x in entries:
+        address, _, length = str(x).strip().partition("/")
+        if ":" in address:
+            continue
+        try:
+            length = int(length) if length else 32
+            if not 0 <= length <= 32:
+                raise ValueError(length)
+            mask = (0xffffffff << (32 - length)) & 0xffffffff
+            start = int.from_bytes(socket.inet_pton(socket.AF_INET, address), "big") & mask
+        except (OSError, ValueError):
+            invalid += 1
+            continue
+        ranges.add((start, start | (~mask & 0xffffffff)))
+    if invalid:
+        logging.warning("Skipped {} invalid EDL entries".format(invalid))
+
+    # Merge overlapping and adjacent ranges, then split each merged range back into the fewest CIDRs
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    networks = [x for start, end in merged for x in ipaddress.summarize_address_range(
+        ipaddress.IPv4Address(start), ipaddress.IPv4Address(end))]
+    return [str(x.network_address) if x.num_addresses == 1 else str(x) for x in networks]
 
-    # Make a GET request to get current SmartGroups
-    response = requests.get("https://{}/v2.5/api/app-domains".format(
-        controller_ip), headers=headers, verify=False)
-    response = response.json()
-    
-    # Filter SmartGroups for when the name starts with "fqdn_"
-    github_smartgroups = [x for x in response['app_domains'] if x["name"].startswith("external_github_")]
-    return github_smartgroups
+# Fetch and normalize one source.  Returns the source version and the CIDRs of each list, or no lists when unchanged.
+def fetch_edl_source(source, cached):
+    # A source is only skipped when it is unchanged and configured the same as at its last sync
+    cached_version = cached.get("version") if cached.get("config") == source else None
+    version, stream = open_edl_source(source, cached_version)
+    if stream is None:
+        logging.debug("EDL source {} not modified: {}".format(source["source"], version))
+        return {"version": version, "lists": None, "error": None}
+    with stream:
+        lists = {name: normalize_edl_entries(entries)
+                 for name, entries in EDL_ADAPTERS[source["type"]](stream, source).items()}
+    return {"version": version, "lists": lists, "error": None}
+
+# Fetch every source concurrently.  Results are returned in the order of the sources and a failed source does not stop the others.
+def fetch_edl_sources(sources, cache):
+    def fetch(source):
+        try:
+            return fetch_edl_source(source, cache.get(source["source"], {}))
+        except Exception as e:
+            logging.error("EDL source {} failed: {}".format(source["source"], e))
+            return {"version": None, "lists": None, "error": str(e)}
+
+    with ThreadPoolExecutor(max_workers=max(1, EDL_FETCH_WORKERS)) as executor:
+        return list(executor.map(fetch, sources))
+
+def get_edl_smartgroups(controller_ip, cid):
+    # Get the SmartGroups whose name starts with "external_"
+    return get_app_domains_by_prefix(get_app_domains(controller_ip, cid), "external_")
 
 # Function to update the a Webgroup type SmartGroup by adding or removing a domain.  Input is a list of domains to add or remove.
-def update_github_smartgroup_cidrs(controller_ip, github_smartgroups, github_ips, endpoint, cid):
+def update_edl_smartgroup_cidrs(controller_ip, edl_smartgroups, smartgroup_name, cidrs, cid):
     # URL for the controller API
     url = "https://{}/v2.5/api".format(controller_ip) 
     # Parameters to send for the GET request
@@ -100,29 +268,25 @@ def update_github_smartgroup_cidrs(controller_ip, github_smartgroups, github_ips
     ## EXAMPLE SMARTGROUP JSON
     # [{'uuid': '60477a53-72d0-4175-a3f6-5b861b77cfed', 'name': 'external_github_git', 'selector': {'any': [{'all': {'cidr': '1.1.1.1'}}]}, 'system_resource': False}]
 
-    ## EXAMPLE GITHUB ENDPOINT NAME
-    # "git"
-
-    smartgroup_name = "external_github_{}".format(endpoint)
-
-    # Find the Smartgroup that matches the endpoint
-    github_smartgroups = [x for x in github_smartgroups if x["name"] == smartgroup_name]
+    # Find the Smartgroup that matches the list in the name index
+    smartgroup = edl_smartgroups.get(smartgroup_name)
 
     # If no SmartGroup is found, set the created flag to True.  If a SmartGroup is found, set the created flag to False.
-    created = False
-    if len(github_smartgroups) > 0:
-        created = True
+    created = smartgroup is not None
+
+    # Skip the update when the SmartGroup already matches the published CIDRs, every PUT is pushed to all gateways
+    if created and same_cidrs(get_selector_cidrs(smartgroup), cidrs):
+        logging.debug("SmartGroup {} unchanged".format(smartgroup_name))
+        return {"result": "Unchanged", "status": "unchanged"}
 
     # Format the new SmartGroup/WebGroup payload
     selector = []
-    for cidr in github_ips[endpoint]:
-        # Filter out ipv6 addresses and add v4 addresses to the selector
-        if ":" not in cidr:
-            selector.append({
-                "all": {
-                    "cidr": cidr
-                }
-            })
+    for cidr in cidrs:
+        selector.append({
+            "all": {
+                "cidr": cidr
+            }
+        })
     smartgroup_config = {
         "name": smartgroup_name,
         "selector": {
@@ -134,20 +298,27 @@ def update_github_smartgroup_cidrs(controller_ip, github_smartgroups, github_ips
 
     # If the SmartGroup exists, extract the UUID and update the SmartGroup.  If the SmartGroup does not exist, create the SmartGroup.
     if created:
-        smartgroup = github_smartgroups[0]
         # Make a PUT request to set the policies
-        response = requests.put("https://{}/v2.5/api/app-domains/{}".format(
+        acquire_controller_token()
+        response = get_controller_session().put("https://{}/v2.5/api/app-domains/{}".format(
             controller_ip, smartgroup["uuid"]), json=smartgroup_config, headers=headers, verify=False)
     else: 
         # Make a POST request to create the SmartGroup
-        response = requests.post("https://{}/v2.5/api/app-domains".format(
+        acquire_controller_token()
+        response = get_controller_session().post("https://{}/v2.5/api/app-domains".format(
             controller_ip), json=smartgroup_config, headers=headers, verify=False)
 
+    invalidate_app_domains(controller_ip)
+
     # Log the response
     logging.debug("Response to SmartGroup Update: {} {}".format(response.status_code,response.text))
 
     # Return the results and current filter list
-    return {"result": response.json()}
+    if not response.ok:
+        status = "failed"
+    else:
+        status = "changed" if created else "created"
+    return {"result": response.json(), "status": status}
 
 print(handler(
     None, None))
@@ -53,6 +53,9 @@ resource "aws_lambda_function" "default" {
       AVIATRIX_USERNAME = var.controller_user
       AVIATRIX_PASSWORD = var.controller_password
       GITHUB_ENDPOINTS = jsonencode(var.git_services)
+      EDL_SOURCES = jsonencode(var.edl_sources)
+      CONTROLLER_MAX_IN_FLIGHT = var.controller_max_in_flight
+      CONTROLLER_RATE_LIMIT = var.controller_rate_limit
     }
   }
 
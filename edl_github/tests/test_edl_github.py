@@ -0,0 +1,167 @@
+# Unit tests for the EDL source fetch and sync of the EDL Lambda, against a local HTTP stand-in for the EDL source and
+# an in-process stand-in for the controller API.  Run from the repository root with "python3 -m pytest edl_github/tests"
+import contextlib
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# EDL source stand-in - serves the current document with its ETag, and a 304 when If-None-Match has that ETag
+source = {"etag": '"v1"', "document": {"git": ["192.0.2.0/25", "192.0.2.128/25"]}, "requests": []}
+
+class SourceRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        source["requests"].append(self.headers.get("If-None-Match"))
+        if self.path != "/meta":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.headers.get("If-None-Match") == source["etag"]:
+            self.send_response(304)
+            self.end_headers()
+            return
+        data = json.dumps(source["document"]).encode()
+        self.send_response(200)
+        self.send_header("ETag", source["etag"])
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+server = HTTPServer(("127.0.0.1", 0), SourceRequestHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+SOURCE_URL = "http://127.0.0.1:{}".format(server.server_port)
+
+# Import the function with its cache in a temporary directory.  The import-time test call fetches a missing source,
+# which fails before the controller is contacted.
+directory = tempfile.mkdtemp()
+os.environ["EDL_CACHE"] = os.path.join(directory, "edl_cache.json")
+os.environ["EDL_SOURCES"] = json.dumps([{"source": "import", "type": "text", "url": SOURCE_URL + "/missing", "name": "list"}])
+os.environ["AVIATRIX_CONTROLLER_IP"] = "controller.test"
+os.environ["CONTROLLER_RATE_LIMIT"] = "0"
+FUNCTION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda_function", "function.py")
+spec = importlib.util.spec_from_file_location("edl_github_function", FUNCTION)
+function = importlib.util.module_from_spec(spec)
+with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+    spec.loader.exec_module(function)
+aviatrix_client = sys.modules["aviatrix_client"]
+
+SOURCES = [{"source": "github", "type": "json", "url": SOURCE_URL + "/meta", "lists": {"git": "git"}}]
+
+
+class FakeResponse:
+    def __init__(self, status_code, payload):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.text = json.dumps(payload)
+        self.content = self.text.encode()
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+# Controller stand-in - records every request and keeps the SmartGroups written to it.  Writes fail with write_status.
+class FakeControllerSession:
+    def __init__(self):
+        self.app_domains = []
+        self.requests = []
+        self.write_status = 200
+
+    def get(self, url, **kwargs):
+        self.requests.append(("GET", url))
+        return FakeResponse(200, {"app_domains": json.loads(json.dumps(self.app_domains))})
+
+    def post(self, url, **kwargs):
+        self.requests.append(("POST", url))
+        if "json" not in kwargs:
+            return FakeResponse(200, {"CID": "test-cid"})
+        if self.write_status >= 400:
+            return FakeResponse(self.write_status, {"return": False})
+        smartgroup = dict(kwargs["json"], uuid="uuid-{}".format(len(self.app_domains)))
+        self.app_domains.append(smartgroup)
+        return FakeResponse(200, {"return": True, "uuid": smartgroup["uuid"]})
+
+    def put(self, url, **kwargs):
+        self.requests.append(("PUT", url))
+        if self.write_status >= 400:
+            return FakeResponse(self.write_status, {"return": False})
+        uuid = url.rsplit("/", 1)[1]
+        self.app_domains = [dict(kwargs["json"], uuid=uuid) if x["uuid"] == uuid else x for x in self.app_domains]
+        return FakeResponse(200, {"return": True})
+
+    def selector_cidrs(self, name):
+        return [[y["all"]["cidr"] for y in x["selector"]["any"]] for x in self.app_domains if x["name"] == name]
+
+
+class EdlSyncTest(unittest.TestCase):
+    def setUp(self):
+        os.environ["EDL_SOURCES"] = json.dumps(SOURCES)
+        if os.path.exists(function.EDL_CACHE):
+            os.remove(function.EDL_CACHE)
+        source.update(etag='"v1"', document={"git": ["192.0.2.0/25", "192.0.2.128/25"]}, requests=[])
+        self.controller = FakeControllerSession()
+        aviatrix_client.controller_session = self.controller
+        aviatrix_client.cid_cache.clear()
+        aviatrix_client.app_domains_cache.clear()
+
+    def tearDown(self):
+        aviatrix_client.controller_session = None
+
+    def sync(self):
+        return json.loads(function.handler(None, None)["body"])
+
+    def test_open_edl_source_uses_the_etag(self):
+        version, stream = function.open_edl_source(SOURCES[0], None)
+        with stream:
+            self.assertEqual(json.load(stream), source["document"])
+        self.assertEqual(version, '"v1"')
+
+        self.assertEqual(function.open_edl_source(SOURCES[0], '"v1"'), ('"v1"', None))
+        self.assertEqual(source["requests"], [None, '"v1"'])
+
+    def test_not_modified_source_skips_the_controller(self):
+        result = self.sync()
+        self.assertEqual(result["created"], 1)
+        self.assertEqual(self.controller.selector_cidrs("external_github_git"), [["192.0.2.0/24"]])
+
+        del self.controller.requests[:]
+        result = self.sync()
+        self.assertEqual(result["not_modified"], ["github"])
+        self.assertEqual(result["results"], [])
+        self.assertEqual(source["requests"][-1], '"v1"')
+        # No login, listing or write once the source answers 304
+        self.assertEqual(self.controller.requests, [])
+
+    def test_etag_change_resyncs(self):
+        self.sync()
+
+        source.update(etag='"v2"', document={"git": ["198.51.100.7"]})
+        result = self.sync()
+        self.assertEqual(result["changed"], 1)
+        self.assertEqual(self.controller.selector_cidrs("external_github_git"), [["198.51.100.7"]])
+        with open(function.EDL_CACHE) as f:
+            self.assertEqual(json.load(f)["github"]["version"], '"v2"')
+
+    def test_failed_group_does_not_save_the_version(self):
+        self.controller.write_status = 500
+        result = self.sync()
+        self.assertEqual(result["failed"], 1)
+        self.assertNotIn("github", function.load_edl_cache())
+
+        # The next run fetches the source again rather than getting a 304, and retries the update
+        self.controller.write_status = 200
+        result = self.sync()
+        self.assertEqual(source["requests"][-1], None)
+        self.assertEqual(result["created"], 1)
+        self.assertEqual(function.load_edl_cache()["github"]["version"], '"v1"')
+
+
+if __name__ == "__main__":
+    unittest.main()
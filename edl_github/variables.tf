@@ -27,4 +27,19 @@ variable "frequency_minutes" {
 # List of services to be created as SmartGroups
 variable "git_services" {
   default = ["git","web"] 
-}
\ No newline at end of file
+}
+
+# External dynamic list sources, each list is synced to an external_<source>_<name> SmartGroup.  When empty the
+# git_services GitHub endpoints are synced.  See EDL_SOURCES in lambda_function/function.py for the source format.
+variable "edl_sources" {
+  type    = any
+  default = []
+}
+
+variable "controller_max_in_flight" {
+  default = 8
+}
+
+variable "controller_rate_limit" {
+  default = 10
+}
@@ -0,0 +1,104 @@
+from time import perf_counter
+import argparse
+import numpy as np
+import pandas as pd
+
+from egress_policy_recommendation import normalize_dcf_logs, process_dcf_logs, process_dcf_logs_parallel
+
+# Benchmark of the L7/L4 recommendation processors on synthetic DCF logs.  Compares the original row by row
+# implementation on raw logs with the vectorized single pass on normalized logs.
+#
+# python3 benchmark_processors.py --rows 1000000 10000000
+
+
+# Build a raw DCF log frame with the same fields and value formats as CoPilot returns
+def synthetic_dcf_logs(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    mitm = rng.random(rows) < 0.5
+    ephemeral = rng.integers(32768, 61000, rows)
+    service = rng.choice([22, 53, 80, 443, 8443], rows)
+    # Half of the L4 logs are seen in the reverse direction
+    reverse = rng.random(rows) < 0.5
+    # Draw addresses from fixed pools of workloads and egress destinations
+    sources = np.array(['10.1.{}.{}'.format(i >> 8, i & 255) for i in range(4096)], dtype=object)
+    destinations = np.array(['52.{}.{}.{}'.format(i >> 16, (i >> 8) & 255, i & 255)
+                             for i in rng.integers(0, 2**24, 50000)], dtype=object)
+    source_ip = sources[rng.integers(0, len(sources), rows)]
+    destination_ip = destinations[rng.integers(0, len(destinations), rows)]
+    hostnames = np.array(['h{}.tenant{}.example.com'.format(i % 500, i // 500) for i in range(5000)], dtype=object)
+    # Share the tag lists between rows, the processors only read them
+    tags = np.where(mitm, pd.Series([['mitm', 'microseg']]*rows), pd.Series([['ebpf', 'microseg']]*rows))
+    return pd.DataFrame({
+        'id': np.arange(rows).astype(str),
+        'timestamp': '2024-05-08T19:49:34.000Z',
+        'policyUuid': 'e82f04ad-ca90-4507-8552-65ddb052f394',
+        'sourceIp': np.where(reverse & ~mitm, destination_ip, source_ip),
+        'destinationIp': np.where(reverse & ~mitm, source_ip, destination_ip),
+        'protocol': rng.choice(['TCP', 'UDP'], rows),
+        'sourcePort': np.where(reverse & ~mitm, service, ephemeral),
+        'destinationPort': np.where(reverse & ~mitm, ephemeral, service),
+        'gatewayHostname': 'cloud-spoke',
+        'action': 'PERMIT',
+        'isEnforced': True,
+        'tags': tags,
+        'mitmSniHostname': np.where(mitm, hostnames[rng.integers(0, len(hostnames), rows)], None),
+        '_searchAfter': None,
+    })
+
+# The processors as originally written, filtering with a per row apply and swapping through .values copies
+def legacy_process_l7_webgroup(df):
+    df = df[df['tags'].apply(lambda x: 'mitm' in x)].copy()
+    if len(df)>0:
+        return df.groupby(['destinationPort', 'protocol'])['mitmSniHostname'].unique().to_json(indent=1)
+    else:
+        return {}
+
+def legacy_process_l4_smartgroups(df):
+    df = df[df['tags'].apply(lambda x: 'ebpf' in x)].copy()
+    if len(df)>0:
+        df['src_port'] = df['sourcePort']
+        df['dst_port'] = df['destinationPort']
+        df['src_ip'] = df['sourceIp']
+        df['dst_ip'] = df['destinationIp']
+        df.loc[df['sourcePort'] < df['destinationPort'], ['src_port', 'dst_port']] = df.loc[df['sourcePort'] < df['destinationPort'], ['dst_port', 'src_port']].values
+        df.loc[df['sourcePort'] < df['destinationPort'], ['src_ip', 'dst_ip']] = df.loc[df['sourcePort'] < df['destinationPort'], ['dst_ip', 'src_ip']].values
+        return df.groupby(['dst_port', 'protocol'])['dst_ip'].unique().to_json(indent=1)
+    else:
+        return {}
+
+def timed(function, *args):
+    start = perf_counter()
+    result = function(*args)
+    return result, perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='DCF Recommendation Processor Benchmark')
+    parser.add_argument('--rows', type=int, nargs='+', help='Synthetic log counts', default=[1000000, 10000000])
+    parser.add_argument('--skip_legacy', action='store_true', help='Only time the vectorized processors')
+    parser.add_argument('--processes', type=int, help='Also time the parallel engine with this many processes',
+                        default=0)
+    args = parser.parse_args()
+
+    print("{:>10} {:>12} {:>12} {:>12} {:>10}".format('rows', 'legacy_s', 'normalize_s', 'vectorized_s', 'speedup'))
+    for rows in args.rows:
+        raw = synthetic_dcf_logs(rows)
+        legacy_seconds = float('nan')
+        if not args.skip_legacy:
+            legacy_l7, l7_seconds = timed(legacy_process_l7_webgroup, raw)
+            legacy_l4, l4_seconds = timed(legacy_process_l4_smartgroups, raw)
+            legacy_seconds = l7_seconds + l4_seconds
+        df, normalize_seconds = timed(normalize_dcf_logs, raw)
+        del raw
+        (l7, l4), vectorized_seconds = timed(process_dcf_logs, df)
+        if not args.skip_legacy and (l7, l4) != (legacy_l7, legacy_l4):
+            print("WARNING: vectorized output differs from the legacy output for {} rows".format(rows))
+        print("{:>10} {:>12.2f} {:>12.2f} {:>12.2f} {:>9.1f}x".format(
+            rows, legacy_seconds, normalize_seconds, vectorized_seconds, legacy_seconds/vectorized_seconds))
+        if args.processes > 1:
+            parallel, parallel_seconds = timed(process_dcf_logs_parallel, df, args.processes)
+            if parallel != (l7, l4):
+                print("WARNING: parallel output differs from the vectorized output for {} rows".format(rows))
+            print("{:>10} parallel engine with {} processes: {:.2f}s".format(rows, args.processes, parallel_seconds))
+
+if __name__ == "__main__":
+    main()
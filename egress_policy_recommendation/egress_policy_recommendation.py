@@ -1,17 +1,60 @@
-from time import time
+from time import time, perf_counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from queue import Queue, Empty
+from threading import Event, Lock
+import shutil
+import base64
 from requests import Session
-import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import socket
+import ipaddress
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 import urllib3
 import json
 import argparse
 import logging
+import sys
+
+# Shared controller API client, imported from the repository root one level up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from aviatrix_client import get_controller_session, login as controller_login
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 logging.basicConfig(level=logging.INFO)
 
+# Fields returned for each DCF log, see the example L7 log below
+DCF_LOG_COLUMNS = ['id', 'timestamp', 'policyUuid', 'sourceIp', 'destinationIp', 'protocol', 'sourcePort',
+                   'destinationPort', 'gatewayHostname', 'action', 'isEnforced', 'tags', 'mitmSniHostname',
+                   '_searchAfter']
+
+## Normalized in-memory schema for DCF logs
+# Fields that are not used for the analysis are dropped at ingestion
+DCF_LOG_DROPPED_COLUMNS = ['_searchAfter', 'isEnforced']
+# Low cardinality string fields are stored as categoricals
+DCF_LOG_CATEGORICAL_COLUMNS = ['protocol', 'action', 'gatewayHostname', 'policyUuid', 'mitmSniHostname']
+# IPv4 addresses are stored as uint32.  Anything else (IPv6) is stored as 0 and kept as a string in the categorical
+# <column>6 side column, which is only present when a frame has such addresses.
+DCF_LOG_IP_COLUMNS = ['sourceIp', 'destinationIp']
+IP_SIDE_COLUMN_SUFFIX = '6'
+# Integer IP keys are the uint32 IPv4 address, or this offset plus the side column code for other addresses
+IP_KEY_OFFSET = 2**32
+DCF_LOG_PORT_COLUMNS = ['sourcePort', 'destinationPort']
+# The tags list is replaced with a bit-flag column
+TAG_MITM = 1
+TAG_EBPF = 2
+DCF_LOG_TAG_FLAGS = {'mitm': TAG_MITM, 'ebpf': TAG_EBPF}
+
+# Logs already cached are re-fetched for this many milliseconds before the high-water mark to pick up late arrivals
+CACHE_OVERLAP = 5*60*1000
+
+# Bounds for adaptive paging
+MIN_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 10000
+
 def main():
     # use argparse to get arguments for coPilot URL, username, and password
     parser = argparse.ArgumentParser(description='DCF Log Exporter')
@@ -27,21 +70,229 @@ def main():
     parser.add_argument('--export_to_csv', type=bool, help='Export to CSV', default=False)
     parser.add_argument('--relative_start_date', type=float,
                         help='Relative start date in days', default=1)
+    parser.add_argument('--workers', type=int,
+                        help='Number of time slices to fetch concurrently', default=1)
+    parser.add_argument('--page_size', type=int, help='Number of logs requested per page', default=100)
+    parser.add_argument('--adaptive_paging', action='store_true',
+                        help='Grow or shrink the page size based on page latency and payload size')
+    parser.add_argument('--max_page_latency', type=float,
+                        help='Adaptive paging latency limit per page in seconds', default=2.0)
+    parser.add_argument('--max_page_bytes', type=int,
+                        help='Adaptive paging payload size limit per page in bytes', default=8*1024*1024)
+    parser.add_argument('--streaming', action='store_true',
+                        help='Process log pages as they arrive without holding the full log set in memory')
+    parser.add_argument('--aggregate_cidrs', action='store_true',
+                        help='Aggregate recommended SmartGroup IPs into covering CIDRs')
+    parser.add_argument('--max_prefix_length', type=int,
+                        help='Longest prefix in aggregated CIDRs, longer prefixes are widened', default=32)
+    parser.add_argument('--min_prefix_length', type=int,
+                        help='Shortest prefix aggregated CIDRs may be merged into', default=16)
+    parser.add_argument('--max_overcoverage', type=int,
+                        help='Number of unseen addresses aggregated CIDRs may cover per Port/Proto', default=0)
+    parser.add_argument('--wildcard_fanout', type=int,
+                        help='Propose *.domain WebGroup entries for domains with at least this many subdomain labels, 0 to disable',
+                        default=0)
+    parser.add_argument('--wildcard_min_labels', type=int,
+                        help='Minimum number of labels in a domain proposed as a wildcard', default=2)
+    parser.add_argument('--processes', type=int,
+                        help='Number of processes used to analyze the fetched logs', default=1)
+    parser.add_argument('--cache_dir', type=str,
+                        help='Directory for a local Parquet cache of fetched logs, only logs newer than the cache are fetched')
+    parser.add_argument('--cache_max_age', type=float, help='Evict cached logs older than this many days')
+    parser.add_argument('--cache_max_bytes', type=int, help='Evict the oldest cached logs above this total size in bytes')
+    parser.add_argument('--evaluate_rules', type=str,
+                        help='JSON file of proposed DCF rules, replays the logs through the policy list with these rules and reports per rule hit counts')
+    parser.add_argument('--policy_list', type=str,
+                        help='JSON file of the policy list to evaluate against instead of the controller policy list')
+    parser.add_argument('--app_domains', type=str,
+                        help='JSON file of the SmartGroups and WebGroups used in evaluation instead of the controller app-domains')
+    parser.add_argument('--save_summary', type=str,
+                        help='Save the request counts per Port/Proto/Domain and Port/Proto/DstIP as a JSON summary')
+    parser.add_argument('--merge_summaries', type=str, nargs='+',
+                        help='Merge JSON summaries from other runs or gateways into the recommendations')
+    parser.add_argument('--skip_fetch', action='store_true',
+                        help='Do not fetch logs, only analyze the summaries given with --merge_summaries')
+    parser.add_argument('--sketch', action='store_true',
+                        help='Report approximate distinct counts and the top Domains/DstIPs per Port/Proto using fixed size sketches instead of the unique sets')
+    parser.add_argument('--sketch_top_k', type=int,
+                        help='Number of top Domains/DstIPs kept per Port/Proto in sketches', default=SKETCH_TOP_K)
+    parser.add_argument('--sketch_precision', type=int,
+                        help='HyperLogLog precision, sketches use 2**precision bytes per Port/Proto', default=SKETCH_PRECISION)
+    parser.add_argument('--save_sketch', type=str, help='Save the sketches as JSON')
+    parser.add_argument('--merge_sketches', type=str, nargs='+',
+                        help='Merge JSON sketches from other runs, time windows or gateways')
+    parser.add_argument('--batch', type=str,
+                        help='JSON file of jobs with a policy_number and relative_start_date each, fetched over one session with per job outputs')
+    parser.add_argument('--batch_workers', type=int, help='Number of policies fetched concurrently in a batch',
+                        default=4)
+    parser.add_argument('--batch_output_dir', type=str, help='Directory for the batch job outputs', default='.')
+    parser.add_argument('--export', type=str, choices=EXPORT_FORMATS,
+                        help='Export the fetched logs as they arrive, --export_to_csv is the same as --export csv')
+    parser.add_argument('--from_file', type=str,
+                        help='Analyze logs exported as .csv, .parquet or .ndjson instead of fetching them from CoPilot')
     args = parser.parse_args()
+    if args.export_to_csv and not args.export:
+        args.export = 'csv'
+    if args.from_file and (args.skip_fetch or args.batch or args.cache_dir or args.export):
+        parser.error("--from_file is not supported with --skip_fetch, --batch, --cache_dir or exports")
+    if args.from_file and args.evaluate_rules and not (args.policy_list and args.app_domains):
+        parser.error("--evaluate_rules with --from_file requires --policy_list and --app_domains")
+    if args.batch and (args.streaming or args.skip_fetch or args.sketch or args.evaluate_rules or
+                       args.save_summary or args.merge_summaries):
+        parser.error("--batch is not supported with --streaming, --skip_fetch, --sketch, --evaluate_rules or summaries")
+    if args.skip_fetch and not (args.merge_summaries or args.merge_sketches):
+        parser.error("--skip_fetch requires --merge_summaries or --merge_sketches")
+    if args.sketch and (args.save_summary or args.merge_summaries or args.aggregate_cidrs or args.wildcard_fanout > 0):
+        parser.error("--sketch is not supported with summaries, --aggregate_cidrs or --wildcard_fanout")
+    if (args.save_sketch or args.merge_sketches) and not args.sketch:
+        parser.error("--save_sketch and --merge_sketches require --sketch")
+    if not 4 <= args.sketch_precision <= 18:
+        parser.error("--sketch_precision must be between 4 and 18")
+    if args.skip_fetch and (args.cache_dir or args.evaluate_rules):
+        parser.error("--cache_dir and --evaluate_rules are not supported with --skip_fetch")
+    if args.streaming and args.cache_dir:
+        parser.error("--cache_dir is not supported with --streaming")
+    if args.streaming and args.evaluate_rules:
+        parser.error("--evaluate_rules is not supported with --streaming")
+
+    if not (args.skip_fetch or args.from_file):
+        cid = controller_login(args.controller_url, args.username, args.password)
+        if not args.batch:
+            internet_policy_uuids = get_internet_policy_uuids(args.controller_url, cid, policy_number=args.policy_number)
+
+        s = copilot_login(args.username, args.password, args.copilot_url)
+    if args.batch:
+        write_batch_recommendations(s, args.copilot_url, load_batch_jobs(args.batch),
+                                    get_policy_list(args.controller_url, cid), args)
+        copilot_logout(s, copilot_url=args.copilot_url)
+        return
+    # Summaries are kept as request count accumulators, the same as streaming
+    summarize = not args.sketch and (args.streaming or args.skip_fetch or bool(args.save_summary or args.merge_summaries))
+    if args.skip_fetch:
+        web_groups, smart_groups = {}, {}
+    elif args.streaming and args.from_file:
+        pages = iter_dcf_log_file(args.from_file)
+        if args.sketch:
+            web_groups, smart_groups = accumulate_dcf_log_sketches(pages, args.sketch_precision, args.sketch_top_k)
+        else:
+            web_groups, smart_groups = accumulate_dcf_log_pages(pages)
+    elif args.streaming:
+        start_time, end_time = get_dcf_log_time_window(args.relative_start_date)
+        pages = iter_dcf_log_pages(s, args.copilot_url, start_time, end_time, internet_policy_uuids,
+                                   workers=args.workers, page_size=args.page_size,
+                                   adaptive_paging=args.adaptive_paging, max_page_latency=args.max_page_latency,
+                                   max_page_bytes=args.max_page_bytes)
+        if args.export:
+            pages = export_dcf_log_pages(pages, get_dcf_log_export_filename(
+                '{}_{}'.format(args.policy_number, start_time), args.export), args.export)
+        if args.sketch:
+            web_groups, smart_groups = accumulate_dcf_log_sketches(pages, args.sketch_precision, args.sketch_top_k)
+        else:
+            web_groups, smart_groups = accumulate_dcf_log_pages(pages)
+    else:
+        if args.from_file:
+            logs_df = read_dcf_log_file(args.from_file)
+        else:
+            logs_df = get_dcf_logs(s, args.copilot_url, args.relative_start_date,
+                         internet_policy_uuids,args.policy_number, bool(args.export),
+                         workers=args.workers, page_size=args.page_size,
+                         adaptive_paging=args.adaptive_paging, max_page_latency=args.max_page_latency,
+                         max_page_bytes=args.max_page_bytes, cache_dir=args.cache_dir,
+                         cache_max_age=args.cache_max_age, cache_max_bytes=args.cache_max_bytes,
+                         export_format=args.export or 'csv')
+        if args.sketch and args.processes > 1:
+            web_groups, smart_groups = sketch_dcf_logs_parallel(logs_df, args.processes, args.sketch_precision,
+                                                                args.sketch_top_k)
+        elif args.sketch:
+            web_groups, smart_groups = sketch_dcf_logs(logs_df, args.sketch_precision, args.sketch_top_k)
+        elif summarize:
+            flows = orient_dcf_flows(logs_df)
+            web_groups, smart_groups = update_l7_webgroup({}, flows), update_l4_smartgroups({}, flows)
+        elif args.processes > 1:
+            unique_sni_hostnames, non_web_egress = process_dcf_logs_parallel(logs_df, args.processes)
+        else:
+            unique_sni_hostnames, non_web_egress = process_dcf_logs(logs_df)
+        if args.wildcard_fanout > 0 and not summarize:
+            web_groups = count_by_port_proto(filter_l7_logs(logs_df), 'destinationPort', 'mitmSniHostname')
+    if summarize:
+        for filename in args.merge_summaries or []:
+            other_web_groups, other_smart_groups = load_dcf_log_summary(filename)
+            merge_unique_groups(web_groups, other_web_groups)
+            merge_unique_groups(smart_groups, other_smart_groups)
+        if args.save_summary:
+            save_dcf_log_summary(args.save_summary, web_groups, smart_groups)
+        unique_sni_hostnames, non_web_egress = format_unique_groups(web_groups), format_unique_groups(smart_groups)
+    if args.sketch:
+        for filename in args.merge_sketches or []:
+            other_web_groups, other_smart_groups = load_dcf_log_sketches(filename)
+            merge_sketches(web_groups, other_web_groups, args.sketch_top_k)
+            merge_sketches(smart_groups, other_smart_groups, args.sketch_top_k)
+        if args.save_sketch:
+            save_dcf_log_sketches(args.save_sketch, web_groups, smart_groups)
+        print("Approximate distinct and top Port/Proto/Domains with [requests, error]:")
+        print(format_sketches(web_groups, args.sketch_top_k))
+        print("Approximate distinct and top Port/Proto/DstIP with [requests, error]:")
+        print(format_sketches(smart_groups, args.sketch_top_k))
+    else:
+        if args.aggregate_cidrs:
+            non_web_egress = aggregate_smartgroup_recommendations(non_web_egress, args.max_prefix_length,
+                                                                  args.min_prefix_length, args.max_overcoverage)
+        print("Unique Port/Proto/Domains for creating Webgroup Policies:")
+        print(unique_sni_hostnames)
+        if args.wildcard_fanout > 0:
+            print("Proposed Port/Proto/Domains with wildcards and request coverage:")
+            print(propose_webgroup_wildcards(web_groups, args.wildcard_fanout, args.wildcard_min_labels))
+        print("Unique Port/Proto/DstIP for creating SmartGroup Policies:")
+        print(non_web_egress)
+    if args.evaluate_rules:
+        policies = load_json_list(args.policy_list, 'policies') if args.policy_list else \
+            get_policy_list(args.controller_url, cid)
+        app_domains = load_json_list(args.app_domains, 'app_domains') if args.app_domains else \
+            get_app_domains(args.controller_url, cid)
+        print("Rule hit counts with the proposed rules:")
+        print(evaluate_policy_rules(logs_df, policies, app_domains, load_json_list(args.evaluate_rules, 'policies')))
+    if not (args.skip_fetch or args.from_file):
+        copilot_logout(s, copilot_url=args.copilot_url)
 
-    cid = controller_login(args.controller_url, args.username, args.password)
-    internet_policy_uuids = get_internet_policy_uuids(args.controller_url, cid, policy_number=args.policy_number)
 
-    s = copilot_login(args.username, args.password, args.copilot_url)
-    logs_df = get_dcf_logs(s, args.copilot_url, args.relative_start_date,
-                 internet_policy_uuids,args.policy_number, args.export_to_csv)
-    unique_sni_hostnames = process_l7_webgroup(logs_df)
-    print("Unique Port/Proto/Domains for creating Webgroup Policies:")
-    print(unique_sni_hostnames)
-    non_web_egress = process_l4_smartgroups(logs_df)
-    print("Unique Port/Proto/DstIP for creating SmartGroup Policies:")
-    print(non_web_egress)
-    copilot_logout(s, copilot_url=args.copilot_url)
+# Run the recommendations of every batch job with the single run options and write them to
+# <batch_output_dir>/recommendations_<policy_number>_<relative_start_date>d.json
+def write_batch_recommendations(s, copilot_url, jobs, policies, args):
+    os.makedirs(args.batch_output_dir, exist_ok=True)
+    for job, logs_df in get_dcf_logs_batch(s, copilot_url, jobs, policies, batch_workers=args.batch_workers,
+                                           workers=args.workers, page_size=args.page_size,
+                                           adaptive_paging=args.adaptive_paging,
+                                           max_page_latency=args.max_page_latency,
+                                           max_page_bytes=args.max_page_bytes, cache_dir=args.cache_dir,
+                                           cache_max_age=args.cache_max_age, cache_max_bytes=args.cache_max_bytes):
+        name = '{}_{:g}d'.format(job["policy_number"], job["relative_start_date"])
+        if args.export:
+            export_dcf_logs(logs_df, get_dcf_log_export_filename(name, args.export), args.export)
+        if args.processes > 1:
+            unique_sni_hostnames, non_web_egress = process_dcf_logs_parallel(logs_df, args.processes)
+        else:
+            unique_sni_hostnames, non_web_egress = process_dcf_logs(logs_df)
+        if args.aggregate_cidrs:
+            non_web_egress = aggregate_smartgroup_recommendations(non_web_egress, args.max_prefix_length,
+                                                                  args.min_prefix_length, args.max_overcoverage)
+        result = {
+            "policy_number": job["policy_number"],
+            "relative_start_date": job["relative_start_date"],
+            "policy_uuids": job["policy_uuids"],
+            "logs": len(logs_df),
+            # The processors return {} when there are no logs
+            "web_groups": json.loads(unique_sni_hostnames) if isinstance(unique_sni_hostnames, str) else {},
+            "smart_groups": json.loads(non_web_egress) if isinstance(non_web_egress, str) else {}
+        }
+        if args.wildcard_fanout > 0:
+            web_groups = count_by_port_proto(filter_l7_logs(logs_df), 'destinationPort', 'mitmSniHostname')
+            result["wildcards"] = json.loads(propose_webgroup_wildcards(web_groups, args.wildcard_fanout,
+                                                                        args.wildcard_min_labels) or '{}')
+        filename = os.path.join(args.batch_output_dir, 'recommendations_{}.json'.format(name))
+        with open(filename, 'w') as f:
+            json.dump(result, f, indent=1)
+        print("Wrote {} logs of policy {} for the last {:g} days to {}".format(
+            len(logs_df), job["policy_number"], job["relative_start_date"], filename))
 
 
 def copilot_login(username, password, copilot_url):
@@ -51,37 +302,32 @@ def copilot_login(username, password, copilot_url):
     }
 
     s = Session()
+    s.mount("https://", copilot_adapter())
     r = s.post("https://"+copilot_url+'/api/login',
                json=login_payload, verify=False)
     return s
 
+# Pooled CoPilot connections that retry transient errors.  CoPilot log queries are POSTs that do not change
+# anything, so every method is retried.
+def copilot_adapter(pool_maxsize=10):
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504],
+                    allowed_methods=None, raise_on_status=False)
+    return HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retries)
+
+# Allow at least pool_maxsize pooled connections on a CoPilot session, fetches sharing the session never shrink it
+def ensure_copilot_pool(s, pool_maxsize):
+    if getattr(s.get_adapter("https://"), '_pool_maxsize', 0) < pool_maxsize:
+        s.mount("https://", copilot_adapter(pool_maxsize=pool_maxsize))
+
 
 def copilot_logout(s, copilot_url):
     r = s.get("https://"+copilot_url+'/api/logout', verify=False)
     return r
 
 
-def controller_login(controller_ip, controller_user, controller_password):
-    # URL for the controller API
-    url = "https://{}/v2/api".format(controller_ip)
-    # Payload to send for login
-    payload = {'action': 'login',
-               'username': controller_user,
-               'password': controller_password}
-
-    headers = {}
-
-    # Make a POST request to the URL with the payload
-    response = requests.post(url, headers=headers, data=payload, verify=False)
-
-    # Return the CID from the response
-    return response.json()["CID"]
-
 # Function to update the a Webgroup type SmartGroup by adding or removing a domain.  Input is a list of domains to add or remove.
 
 def get_internet_policy_uuids(controller_ip, cid, policy_number):
-    internet_smartgroup_id = "def000ad-0000-0000-0000-000000000001"
-
     # URL for the controller API
     url = "https://{}/v2.5/api".format(controller_ip)
     # Parameters to send for the GET request
@@ -93,7 +339,7 @@ def get_internet_policy_uuids(controller_ip, cid, policy_number):
     logging.debug("Headers: {}".format(headers))
 
     # Make a GET request to get current SmartGroups
-    response = requests.get("https://{}/v2.5/api/microseg/policy-list".format(
+    response = get_controller_session().get("https://{}/v2.5/api/microseg/policy-list".format(
         controller_ip), headers=headers, verify=False)
     logging.debug("Response for Existing Policy List: {} {}".format(
         response.status_code, response.text))
@@ -102,6 +348,11 @@ def get_internet_policy_uuids(controller_ip, cid, policy_number):
     # Extract current rules from policy list Smartgroup
     policies = response['policies']
 
+    return select_policy_uuids(policies, policy_number)
+
+def select_policy_uuids(policies, policy_number):
+    internet_smartgroup_id = "def000ad-0000-0000-0000-000000000001"
+
     if policy_number > 0:
         # Filter policies based on policy number
         policy_uuids = [x["uuid"] for x in policies if x["priority"] == policy_number]
@@ -118,21 +369,17 @@ def get_internet_policy_uuids(controller_ip, cid, policy_number):
 # {"filterModel":{"items":[{"field":"timestamp","operator":"after","id":1413,"value":"2024-05-07"}],"logicOperator":"and","quickFilterValues":[],"quickFilterLogicOperator":"and"},"order":"desc","searchAfter":[1715182143194],"size":100}
 
 
-def get_dcf_logs(s, copilot_url, relative_start_date, policy_uuids, policy_number, export_to_csv=False):
-    # get current time in milliseconds
-    current_time = int(time()*1000)
-    # get start time in milliseconds
-    start_time = current_time - (relative_start_date*24*60*60*1000)
-    start_time_iso = pd.to_datetime(start_time, unit='ms')
-    logging.debug(start_time_iso.isoformat())
-    page_size = 100
-    # create payload to get DCF logs
+def build_dcf_log_payload(policy_uuids, start_time_iso, end_time_iso=None, page_size=100):
+    # create payload to get DCF logs, optionally bounded on both sides of the time window
+    filter_items = [
+        {"field": "policyUuid", "operator": "include", "value": policy_uuids},
+        {"field": "timestamp", "operator": "after", "value": start_time_iso}
+        ]
+    if end_time_iso:
+        filter_items.append({"field": "timestamp", "operator": "before", "value": end_time_iso})
     payload = {
         "filterModel": {
-            "items": [
-                {"field": "policyUuid", "operator": "include", "value": policy_uuids},
-                {"field": "timestamp", "operator": "after", "value": start_time_iso.isoformat()}
-                ],
+            "items": filter_items,
             "logicOperator": "and",
             "quickFilterLogicOperator": "and",
             "quickFilterValues": []
@@ -140,67 +387,1245 @@ def get_dcf_logs(s, copilot_url, relative_start_date, policy_uuids, policy_numbe
         "order": "desc",
         "size": page_size
     }
+    return payload
 
+# Split a [start_time, end_time] window in milliseconds into equal slices, newest slice first
+def split_time_window(start_time, end_time, slices):
+    slices = max(1, int(slices))
+    step = (end_time - start_time) / slices
+    boundaries = [start_time + step * i for i in range(slices)] + [end_time]
+    return [(boundaries[i], boundaries[i+1]) for i in reversed(range(slices))]
+
+def get_dcf_log_count(s, copilot_url, payload):
     count = s.post("https://"+copilot_url +
                    '/api/microseg/policies/logs/count', json=payload, verify=False)
     logging.debug(count.json())
+    return count.json()['total']
 
-    iterations = count.json()['total']//page_size
-    logging.debug(iterations)
+# Adaptive paging - double the page size while a page stays under both limits, halve it when either is exceeded
+def next_page_size(page_size, elapsed, payload_bytes, max_page_latency, max_page_bytes,
+                   min_page_size=MIN_PAGE_SIZE, max_page_size=MAX_PAGE_SIZE):
+    if elapsed > max_page_latency or payload_bytes > max_page_bytes:
+        return max(min_page_size, page_size//2)
+    if elapsed < max_page_latency/2 and payload_bytes < max_page_bytes/2:
+        return min(max_page_size, page_size*2)
+    return page_size
 
-    search_after = None
-    df = pd.DataFrame()
+# Walk a single time slice page by page using searchAfter, yielding each page until an empty page is returned
+def iter_dcf_log_slice(s, copilot_url, payload, adaptive_paging=False,
+                       max_page_latency=2.0, max_page_bytes=8*1024*1024):
+    payload = dict(payload)
 
-    print("Getting {} DCF Logs...".format(count.json()['total']))
-    for i in tqdm(range(iterations)):
-        if search_after:
-            payload['searchAfter'] = [ search_after ]
+    while True:
+        page_start = perf_counter()
         r = s.post("https://"+copilot_url +
                    '/api/microseg/policies/logs', json=payload, verify=False)
+        elapsed = perf_counter() - page_start
         logging.debug(r.json())
-        # concat the new data to the dataframe
-        df = pd.concat([df, pd.DataFrame(r.json()['items'])])
-        search_after = max([x['_searchAfter'] for x in r.json()['items']])
-        logging.debug(search_after)
+        items = r.json()['items']
+        if len(items) == 0:
+            break
+        # Results are ordered newest first, so the last row carries the cursor for the next page
+        payload['searchAfter'] = items[-1]['_searchAfter']
+        logging.debug(payload['searchAfter'])
+        if adaptive_paging:
+            payload['size'] = next_page_size(payload['size'], elapsed, len(r.content),
+                                             max_page_latency, max_page_bytes)
+            logging.debug("Page size: {}".format(payload['size']))
+        yield items
+
+# get the [start_time, end_time] window in milliseconds for a relative start date in days
+def get_dcf_log_time_window(relative_start_date):
+    # get current time in milliseconds
+    current_time = int(time()*1000)
+    # get start time in milliseconds
+    start_time = current_time - (relative_start_date*24*60*60*1000)
+    return start_time, current_time
+
+# Yield pages of DCF logs as they arrive.  With more than one worker each worker walks its own time slice and
+# pages are yielded in arrival order through a bounded queue.
+def iter_dcf_log_pages(s, copilot_url, start_time, end_time, policy_uuids, workers=1, page_size=100,
+                       adaptive_paging=False, max_page_latency=2.0, max_page_bytes=8*1024*1024):
+    start_time_iso = pd.to_datetime(start_time, unit='ms')
+    logging.debug(start_time_iso.isoformat())
+
+    # With a single worker keep the open-ended window, otherwise give each worker its own time slice
+    if workers > 1:
+        payloads = [build_dcf_log_payload(policy_uuids,
+                                          pd.to_datetime(slice_start, unit='ms').isoformat(),
+                                          pd.to_datetime(slice_end, unit='ms').isoformat(),
+                                          page_size)
+                    for slice_start, slice_end in split_time_window(start_time, end_time, workers)]
+        # Allow one pooled connection per worker on the shared CoPilot session
+        ensure_copilot_pool(s, workers)
+    else:
+        payloads = [build_dcf_log_payload(policy_uuids, start_time_iso.isoformat(), page_size=page_size)]
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        totals = list(executor.map(lambda payload: get_dcf_log_count(s, copilot_url, payload), payloads))
+
+        print("Getting {} DCF Logs...".format(sum(totals)))
+        with tqdm(total=sum(totals)) as progress:
+            if len(payloads) == 1:
+                for page in iter_dcf_log_slice(s, copilot_url, payloads[0], adaptive_paging,
+                                               max_page_latency, max_page_bytes):
+                    progress.update(len(page))
+                    yield page
+                return
+
+            # Bound the number of buffered pages so slow consumers apply back pressure to the workers
+            pages = Queue(maxsize=workers*2)
+            stopped = Event()
+
+            def produce(payload):
+                try:
+                    for page in iter_dcf_log_slice(s, copilot_url, payload, adaptive_paging,
+                                                   max_page_latency, max_page_bytes):
+                        if stopped.is_set():
+                            break
+                        pages.put(page)
+                finally:
+                    pages.put(None)
+
+            futures = [executor.submit(produce, payload) for payload in payloads]
+            try:
+                finished = 0
+                while finished < len(futures):
+                    page = pages.get()
+                    if page is None:
+                        finished += 1
+                        continue
+                    progress.update(len(page))
+                    yield page
+                # Surface any exception raised while walking a slice
+                for future in futures:
+                    future.result()
+            finally:
+                # Unblock any workers still waiting to hand over a page if the consumer stopped early
+                stopped.set()
+                while not all(future.done() for future in futures):
+                    try:
+                        pages.get(timeout=0.1)
+                    except Empty:
+                        pass
+
+## Log export
+# Logs are written incrementally while they are fetched, as CSV, as NDJSON with one raw log per line, or as zstd
+# compressed Parquet with a fixed schema that keeps tags as a list.  Parquet pages are buffered into row groups of
+# EXPORT_ROW_GROUP_ROWS logs.  Exports are read back with --from_file.
+EXPORT_FORMATS = ['csv', 'parquet', 'ndjson']
+EXPORT_ROW_GROUP_ROWS = 128*1024
+
+def get_dcf_log_export_filename(name, export_format):
+    return 'dcf_logs_{}.{}'.format(name, export_format)
+
+def get_dcf_log_arrow_schema():
+    import pyarrow as pa
+    return pa.schema([
+        ('id', pa.string()), ('timestamp', pa.timestamp('ms', tz='UTC')), ('policyUuid', pa.string()),
+        ('sourceIp', pa.string()), ('destinationIp', pa.string()), ('protocol', pa.string()),
+        ('sourcePort', pa.int32()), ('destinationPort', pa.int32()), ('gatewayHostname', pa.string()),
+        ('action', pa.string()), ('isEnforced', pa.bool_()), ('tags', pa.list_(pa.string())),
+        ('mitmSniHostname', pa.string())])
+
+# Open an export and return write(frame) and close() functions.  Frames hold raw log fields.
+def open_dcf_log_export(filename, export_format='csv'):
+    if export_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = get_dcf_log_arrow_schema()
+        writer = pq.ParquetWriter(filename, schema, compression='zstd')
+        buffered = []
+
+        def flush():
+            if len(buffered) > 0:
+                writer.write_table(pa.concat_tables(buffered), row_group_size=EXPORT_ROW_GROUP_ROWS)
+                buffered.clear()
+
+        def write(frame):
+            columns = {}
+            for name in schema.names:
+                if name not in frame.columns:
+                    columns[name] = pd.Series([None]*len(frame), index=frame.index, dtype=object)
+                elif isinstance(frame[name].dtype, pd.CategoricalDtype):
+                    columns[name] = frame[name].astype(object)
+                else:
+                    columns[name] = frame[name]
+            columns['timestamp'] = pd.to_datetime(columns['timestamp'], utc=True)
+            buffered.append(pa.Table.from_pandas(pd.DataFrame(columns), schema=schema, preserve_index=False))
+            if sum(len(x) for x in buffered) >= EXPORT_ROW_GROUP_ROWS:
+                flush()
+
+        def close():
+            flush()
+            writer.close()
+        return write, close
+
+    if export_format == 'ndjson':
+        f = open(filename, 'w')
+
+        def write(frame):
+            if len(frame) > 0:
+                f.write(frame.to_json(orient='records', lines=True, date_format='iso', date_unit='ms').rstrip('\n') + '\n')
+        return write, f.close
+
+    f = open(filename, 'w', newline='')
+    columns = []
+
+    def write(frame):
+        if len(columns) == 0:
+            columns.extend(DCF_LOG_COLUMNS + [x for x in frame.columns if x not in DCF_LOG_COLUMNS])
+        frame.reindex(columns=columns).to_csv(f, header=f.tell() == 0, index=False)
+    return write, f.close
+
+# Append each page to the export as it passes through the pipeline
+def export_dcf_log_pages(pages, filename, export_format='csv'):
+    write, close = open_dcf_log_export(filename, export_format)
+    try:
+        for page in pages:
+            write(pd.DataFrame(page))
+            yield page
+    finally:
+        close()
+
+# Export a normalized frame in row groups, converting back to the raw field formats one group at a time
+def export_dcf_logs(df, filename, export_format='csv'):
+    write, close = open_dcf_log_export(filename, export_format)
+    try:
+        for start in range(0, len(df), EXPORT_ROW_GROUP_ROWS):
+            write(denormalize_dcf_logs(df.iloc[start:start + EXPORT_ROW_GROUP_ROWS]))
+    finally:
+        close()
+
+# Read an export back in chunks of raw log fields, the format is taken from the file extension.  Only the columns
+# used by the analysis are read, Parquet files are memory mapped and read one record batch at a time.
+def iter_dcf_log_file(filename, chunk_rows=EXPORT_ROW_GROUP_ROWS):
+    columns = [x for x in DCF_LOG_COLUMNS if x not in DCF_LOG_DROPPED_COLUMNS]
+    if filename.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(filename, memory_map=True)
+        for batch in parquet_file.iter_batches(batch_size=chunk_rows,
+                                               columns=[x for x in columns if x in parquet_file.schema_arrow.names]):
+            yield batch.to_pandas()
+    elif filename.endswith('.ndjson') or filename.endswith('.jsonl'):
+        with pd.read_json(filename, lines=True, chunksize=chunk_rows, dtype=False, convert_dates=False) as reader:
+            for chunk in reader:
+                yield chunk[[x for x in columns if x in chunk.columns]]
+    else:
+        for chunk in pd.read_csv(filename, chunksize=chunk_rows, usecols=lambda x: x in columns,
+                                 dtype={'id': str, 'mitmSniHostname': object}):
+            # Tag lists are written to CSV as their Python representation
+            if 'tags' in chunk.columns:
+                chunk['tags'] = chunk['tags'].fillna('').str.findall(r"'([^']*)'")
+            yield chunk
+
+def read_dcf_log_file(filename):
+    df = concat_dcf_logs([normalize_dcf_logs(x) for x in iter_dcf_log_file(filename)])
+    logging.info("Number of Logs Indexed: {}".format(len(df)))
+    return df
+
+## Local DCF log cache layout
+# <cache_dir>/checkpoints.json - {policy_uuid: {"start": ms, "end": ms}} contiguous time range cached for each policy
+# <cache_dir>/policy=<policy_uuid>/date=<YYYY-MM-DD>/<fetch_start>_<fetch_end>.parquet
+# Concurrent fetches in this process (batch jobs) share the cache, its reads and writes are serialized by a lock
+dcf_log_cache_lock = Lock()
+
+def load_dcf_log_cache_checkpoints(cache_dir):
+    path = os.path.join(cache_dir, 'checkpoints.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_dcf_log_cache_checkpoints(cache_dir, checkpoints):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, 'checkpoints.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoints, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+# Only fetch from the high-water mark when every policy has the whole window cached, otherwise fetch the full window
+def get_dcf_log_cache_fetch_start(cache_dir, policy_uuids, start_time):
+    checkpoints = load_dcf_log_cache_checkpoints(cache_dir)
+    if len(policy_uuids) == 0 or any(uuid not in checkpoints or checkpoints[uuid]['start'] > start_time
+                                     for uuid in policy_uuids):
+        return start_time
+    high_water_mark = min(checkpoints[uuid]['end'] for uuid in policy_uuids)
+    return max(start_time, high_water_mark - CACHE_OVERLAP)
+
+# Write newly fetched logs into per policy, per day partitions and move the high-water marks forward
+def write_dcf_log_cache(cache_dir, df, policy_uuids, fetch_start, start_time, end_time):
+    checkpoints = load_dcf_log_cache_checkpoints(cache_dir)
+    if len(df) > 0:
+        df = df.assign(date=df['timestamp'].dt.strftime('%Y-%m-%d'))
+        for (policy_uuid, date), partition in df.groupby(['policyUuid', 'date'], observed=True):
+            path = os.path.join(cache_dir, 'policy={}'.format(policy_uuid), 'date={}'.format(date))
+            os.makedirs(path, exist_ok=True)
+            partition.drop(columns=['date']).to_parquet(
+                os.path.join(path, '{}_{}.parquet'.format(int(fetch_start), int(end_time))), index=False)
+    for uuid in policy_uuids:
+        if fetch_start > start_time:
+            checkpoints[uuid]['end'] = int(end_time)
+        else:
+            checkpoints[uuid] = {'start': int(start_time), 'end': int(end_time)}
+    save_dcf_log_cache_checkpoints(cache_dir, checkpoints)
+
+# Read the cached logs for the policies within the window, newest first
+def read_dcf_log_cache(cache_dir, policy_uuids, start_time, end_time):
+    start_date = pd.to_datetime(start_time, unit='ms').strftime('%Y-%m-%d')
+    frames = []
+    for uuid in policy_uuids:
+        policy_dir = os.path.join(cache_dir, 'policy={}'.format(uuid))
+        if not os.path.isdir(policy_dir):
+            continue
+        for date_dir in sorted(os.listdir(policy_dir)):
+            if date_dir[len('date='):] < start_date:
+                continue
+            for filename in sorted(os.listdir(os.path.join(policy_dir, date_dir))):
+                frames.append(pd.read_parquet(os.path.join(policy_dir, date_dir, filename)))
+    if len(frames) == 0:
+        return pd.DataFrame()
+    df = concat_dcf_logs(frames)
+    timestamps = pd.to_datetime(df['timestamp'], utc=True)
+    df = df[(timestamps >= pd.to_datetime(start_time, unit='ms', utc=True)) &
+            (timestamps <= pd.to_datetime(end_time, unit='ms', utc=True))]
+    df = df.drop_duplicates(subset='id')
+    return df.sort_values('timestamp', ascending=False, kind='stable', ignore_index=True)
+
+# Evict whole day partitions older than max_age days, then the oldest days until the cache is under max_bytes
+def evict_dcf_log_cache(cache_dir, max_age=None, max_bytes=None):
+    if not os.path.isdir(cache_dir) or (max_age is None and max_bytes is None):
+        return
+    partitions = []
+    for policy_dir in os.listdir(cache_dir):
+        if not policy_dir.startswith('policy='):
+            continue
+        for date_dir in os.listdir(os.path.join(cache_dir, policy_dir)):
+            path = os.path.join(cache_dir, policy_dir, date_dir)
+            size = sum(os.path.getsize(os.path.join(path, x)) for x in os.listdir(path))
+            partitions.append((date_dir[len('date='):], policy_dir[len('policy='):], path, size))
+    partitions.sort()
+
+    evicted = []
+    total_bytes = sum(x[3] for x in partitions)
+    oldest_date = None
+    if max_age is not None:
+        oldest_date = pd.to_datetime(time() - max_age*24*60*60, unit='s').strftime('%Y-%m-%d')
+    for date, uuid, path, size in partitions:
+        if (oldest_date is not None and date < oldest_date) or (max_bytes is not None and total_bytes > max_bytes):
+            shutil.rmtree(path)
+            total_bytes -= size
+            evicted.append((date, uuid))
+    logging.debug("Evicted Cache Partitions: {}".format(evicted))
+
+    # Cached ranges now start after the newest evicted day of each policy
+    checkpoints = load_dcf_log_cache_checkpoints(cache_dir)
+    for date, uuid in evicted:
+        if uuid in checkpoints:
+            next_day = int((pd.Timestamp(date) + pd.Timedelta(days=1)).value // 10**6)
+            checkpoints[uuid]['start'] = max(checkpoints[uuid]['start'], next_day)
+    save_dcf_log_cache_checkpoints(cache_dir, checkpoints)
+
+def get_dcf_logs(s, copilot_url, relative_start_date, policy_uuids, policy_number, export_to_csv=False, workers=1,
+                 page_size=100, adaptive_paging=False, max_page_latency=2.0, max_page_bytes=8*1024*1024,
+                 cache_dir=None, cache_max_age=None, cache_max_bytes=None, export_format='csv'):
+    start_time, current_time = get_dcf_log_time_window(relative_start_date)
+
+    # With a cache only the logs newer than the last checkpoint are fetched
+    fetch_start = start_time
+    if cache_dir:
+        with dcf_log_cache_lock:
+            fetch_start = get_dcf_log_cache_fetch_start(cache_dir, policy_uuids, start_time)
+        logging.info("Fetching DCF Logs after {}".format(pd.to_datetime(fetch_start, unit='ms').isoformat()))
+
+    pages = iter_dcf_log_pages(s, copilot_url, fetch_start, current_time, policy_uuids, workers=workers,
+                               page_size=page_size, adaptive_paging=adaptive_paging,
+                               max_page_latency=max_page_latency, max_page_bytes=max_page_bytes)
+    export_filename = get_dcf_log_export_filename('{}_{}'.format(policy_number, start_time), export_format)
+    if export_to_csv and not cache_dir:
+        pages = export_dcf_log_pages(pages, export_filename, export_format)
+
+    # Build one normalized frame per page and concatenate them once at the end
+    frames = [normalize_dcf_logs(pd.DataFrame(page)) for page in pages]
+    df = concat_dcf_logs(frames)
+    if workers > 1 and len(df) > 0:
+        # Merge the slices back into a single timestamp ordered frame
+        df = df.drop_duplicates(subset='id')
+        df = df.sort_values('timestamp', ascending=False, kind='stable', ignore_index=True)
+
+    if cache_dir:
+        # Merge the delta with the cached partitions
+        with dcf_log_cache_lock:
+            write_dcf_log_cache(cache_dir, df, policy_uuids, fetch_start, start_time, current_time)
+            evict_dcf_log_cache(cache_dir, cache_max_age, cache_max_bytes)
+            df = read_dcf_log_cache(cache_dir, policy_uuids, start_time, current_time)
+        if export_to_csv:
+            export_dcf_logs(df, export_filename, export_format)
 
     logging.debug(df.head())
     logging.info("Number of Logs Indexed: {}".format(len(df)))
-    if export_to_csv:
-        df.to_csv('dcf_logs_{}_{}.csv'.format(policy_number,start_time), index=False)
     return df
 
+## Batch jobs
+# A batch is a JSON list of jobs such as [{"policy_number": 100, "relative_start_date": 7}, ...], policy_number 0
+# selects every internet policy.  Each policy UUID used by the jobs is fetched once over the longest window any of
+# its jobs needs, concurrently over the shared CoPilot session, and every job slices its own window out of the
+# fetched logs.
+
+def load_batch_jobs(filename):
+    return [{"policy_number": int(x.get("policy_number", 0)),
+             "relative_start_date": float(x.get("relative_start_date", 1))}
+            for x in load_json_list(filename, 'jobs')]
+
+# Yield (job, logs) for each job in order
+def get_dcf_logs_batch(s, copilot_url, jobs, policies, batch_workers=4, workers=1, **kwargs):
+    now = int(time()*1000)
+    windows = {}
+    for job in jobs:
+        job["policy_uuids"] = select_policy_uuids(policies, job["policy_number"])
+        for uuid in job["policy_uuids"]:
+            windows[uuid] = max(windows.get(uuid, 0), job["relative_start_date"])
+    logging.info("Fetching {} policies for {} jobs, {:g} of {:g} policy days".format(
+        len(windows), len(jobs), sum(windows.values()),
+        sum(len(x["policy_uuids"])*x["relative_start_date"] for x in jobs)))
+
+    ensure_copilot_pool(s, max(1, batch_workers)*max(1, workers))
+    with ThreadPoolExecutor(max_workers=max(1, batch_workers)) as executor:
+        logs = dict(zip(windows, executor.map(
+            lambda uuid: get_dcf_logs(s, copilot_url, windows[uuid], [uuid], 0, workers=workers, **kwargs),
+            windows)))
+
+    for job in jobs:
+        start = pd.to_datetime(now - job["relative_start_date"]*24*60*60*1000, unit='ms', utc=True)
+        frames = [logs[uuid] for uuid in job["policy_uuids"] if len(logs[uuid]) > 0]
+        df = concat_dcf_logs([x[x['timestamp'] >= start] for x in frames])
+        if len(frames) > 1 and len(df) > 0:
+            df = df.sort_values('timestamp', ascending=False, kind='stable', ignore_index=True)
+        yield job, df
+
 ## Example L7 Log
 # {'id': '6rXBWY8BReV3HGyVDKv4', 'timestamp': '2024-05-08T19:49:34.000Z', 'policyUuid': 'e82f04ad-ca90-4507-8552-65ddb052f394', 'sourceIp': '10.1.88.234', 'destinationIp': '13.107.42.16', 'protocol': 'TCP', 'sourcePort': 49327, 'destinationPort': 443, 'gatewayHostname': 'cloud-spoke', 'action': 'DROP', 'isEnforced': True, 'tags': ['mitm', 'microseg'], 'mitmSniHostname': 'config.edge.skype.com', '_searchAfter': [1715197774000]}
 
+# Pack a dotted quad IPv4 string into 4 bytes, anything that is not IPv4 is packed as None
+def pack_ipv4(value):
+    try:
+        if value.count('.') == 3:
+            return socket.inet_aton(value)
+    except (AttributeError, OSError):
+        pass
+    return None
+
+# Encode IPv4 strings as uint32.  Addresses repeat heavily in flow logs, so only the distinct strings are parsed.
+# Returns the encoded series and a categorical of the non IPv4 address strings, None when there are none.
+def encode_ipv4(series):
+    codes, uniques = pd.factorize(series)
+    packed = [pack_ipv4(x) for x in uniques]
+    # Missing values are factorized to -1 and pick the trailing 0.0.0.0
+    encoded = np.frombuffer(b''.join([x or bytes(4) for x in packed]) + bytes(4), dtype='>u4').astype(np.uint32)
+    ipv4 = pd.Series(encoded[codes], index=series.index, dtype=np.uint32)
+    others = np.array([x if y is None and isinstance(x, str) and x else None for x, y in zip(uniques, packed)] + [None],
+                      dtype=object)
+    if not any(x is not None for x in others):
+        return ipv4, None
+    return ipv4, pd.Series(others[codes], index=series.index, dtype='category')
+
+def decode_ipv4(values):
+    values = np.asarray(values, dtype=np.uint32)
+    octets = [pd.Series((values >> shift) & 255).astype(str) for shift in (24, 16, 8, 0)]
+    return (octets[0] + '.' + octets[1] + '.' + octets[2] + '.' + octets[3]).tolist()
+
+# Integer keys of an IP column and the non IPv4 addresses the keys above IP_KEY_OFFSET refer to
+def ip_keys(df, column):
+    keys = df[column].to_numpy().astype(np.int64)
+    side_column = column + IP_SIDE_COLUMN_SUFFIX
+    if side_column not in df.columns:
+        return keys, np.array([], dtype=object)
+    codes = df[side_column].cat.codes.to_numpy().astype(np.int64)
+    return (np.where(codes >= 0, IP_KEY_OFFSET + codes, keys),
+            df[side_column].cat.categories.to_numpy(dtype=object))
+
+def decode_ip_keys(keys, others):
+    keys = np.asarray(keys, dtype=np.int64)
+    other = keys >= IP_KEY_OFFSET
+    decoded = np.array(decode_ipv4(np.where(other, 0, keys)), dtype=object)
+    decoded[other] = others[keys[other] - IP_KEY_OFFSET]
+    return decoded.tolist()
+
+# Convert a frame of raw DCF log items into the normalized schema
+def normalize_dcf_logs(df):
+    if 'tag_flags' in df.columns or len(df) == 0:
+        return df
+    df = df.drop(columns=[x for x in DCF_LOG_DROPPED_COLUMNS if x in df.columns])
+    for column in DCF_LOG_IP_COLUMNS:
+        if column in df.columns:
+            df[column], others = encode_ipv4(df[column])
+            if others is not None:
+                df[column + IP_SIDE_COLUMN_SUFFIX] = others
+    for column in DCF_LOG_PORT_COLUMNS:
+        if column in df.columns:
+            df[column] = pd.to_numeric(df[column], downcast='unsigned')
+    for column in DCF_LOG_CATEGORICAL_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+    if 'timestamp' in df.columns:
+        df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True)
+    # Tags within a log are distinct, so summing the flags of the exploded tags sets one bit per tag
+    if 'tags' in df.columns:
+        tags = df['tags'].explode()
+        df['tag_flags'] = tags.map(DCF_LOG_TAG_FLAGS).fillna(0).groupby(level=0).sum().astype(np.uint8)
+        df = df.drop(columns=['tags'])
+    else:
+        df['tag_flags'] = np.uint8(0)
+    return df
+
+# Convert a normalized frame back to the raw field formats for export
+def denormalize_dcf_logs(df):
+    if 'tag_flags' not in df.columns:
+        return df
+    df = df.copy()
+    for column in DCF_LOG_IP_COLUMNS:
+        if column in df.columns:
+            keys, others = ip_keys(df, column)
+            df[column] = decode_ip_keys(keys, others)
+    df['tags'] = [[tag for tag, flag in DCF_LOG_TAG_FLAGS.items() if flags & flag] for flags in df['tag_flags']]
+    return df.drop(columns=['tag_flags'] + [x + IP_SIDE_COLUMN_SUFFIX for x in DCF_LOG_IP_COLUMNS
+                                            if x + IP_SIDE_COLUMN_SUFFIX in df.columns])
+
+# Concatenate normalized frames keeping categorical columns categorical across frames
+def concat_dcf_logs(frames):
+    frames = [x for x in frames if len(x) > 0]
+    if len(frames) == 0:
+        return pd.DataFrame()
+    # Frames without non IPv4 addresses get an empty side column when any other frame has one
+    for column in [x + IP_SIDE_COLUMN_SUFFIX for x in DCF_LOG_IP_COLUMNS]:
+        if any(column in x.columns for x in frames):
+            frames = [x if column in x.columns else x.assign(**{column: pd.Categorical(
+                [None]*len(x), categories=pd.Index([], dtype=object))})
+                      for x in frames]
+    for column in DCF_LOG_CATEGORICAL_COLUMNS + [x + IP_SIDE_COLUMN_SUFFIX for x in DCF_LOG_IP_COLUMNS]:
+        if all(column in x.columns and isinstance(x[column].dtype, pd.CategoricalDtype) for x in frames):
+            categories = pd.api.types.union_categoricals([x[column] for x in frames], sort_categories=True).categories
+            frames = [x.assign(**{column: x[column].cat.set_categories(categories)}) for x in frames]
+    return pd.concat(frames, ignore_index=True)
+
+# Sort heuristics for dest IPs if src_port is less than dst_port, switch src and dst ports and IPs
+
+# Compute the L7/L4 tag masks and the src/dst orientation once for both processors.  Returns a frame of the
+# columns needed for the recommendations, frames that are already oriented are returned unchanged.
+def orient_dcf_flows(df):
+    df = normalize_dcf_logs(df)
+    if 'dst_port' in df.columns or len(df) == 0:
+        return df
+    flags = df['tag_flags'].to_numpy()
+    source_port = df['sourcePort'].to_numpy()
+    destination_port = df['destinationPort'].to_numpy()
+    swap = source_port < destination_port
+    if 'mitmSniHostname' in df.columns:
+        hostnames = df['mitmSniHostname'].array
+    else:
+        hostnames = pd.Categorical([None]*len(df))
+    flows = pd.DataFrame({
+        'l7': (flags & TAG_MITM) != 0,
+        'l4': (flags & TAG_EBPF) != 0,
+        'protocol': df['protocol'].array,
+        'destinationPort': destination_port,
+        'mitmSniHostname': hostnames,
+        'dst_port': np.where(swap, source_port, destination_port),
+        'dst_ip': np.where(swap, df['sourceIp'].to_numpy(), df['destinationIp'].to_numpy()),
+    }, index=df.index)
+    # Non IPv4 destinations keep their side column
+    sides = [x + IP_SIDE_COLUMN_SUFFIX for x in ('sourceIp', 'destinationIp')]
+    if any(x in df.columns for x in sides):
+        source, destination = [df[x].to_numpy(dtype=object) if x in df.columns else np.full(len(df), None)
+                               for x in sides]
+        flows['dst_ip' + IP_SIDE_COLUMN_SUFFIX] = pd.Categorical(np.where(swap, source, destination))
+    return flows
+
+# Filter L7 logs inspected by the MITM proxy
+def filter_l7_logs(df):
+    flows = orient_dcf_flows(df)
+    if len(flows) == 0:
+        return flows
+    return flows[flows['l7']]
+
+# Filter L4 logs with a destination address
+def filter_l4_logs(df):
+    flows = orient_dcf_flows(df)
+    if len(flows) == 0:
+        return flows
+    has_destination = flows['dst_ip'] != 0
+    if 'dst_ip' + IP_SIDE_COLUMN_SUFFIX in flows.columns:
+        has_destination |= flows['dst_ip' + IP_SIDE_COLUMN_SUFFIX].notna()
+    return flows[flows['l4'] & has_destination]
+
+# Codes of the values of a flow column and the label of each code.  Grouping runs on integer codes and only the
+# distinct values are decoded back to strings, once for the whole frame.  Missing values have the code -1, which
+# picks the trailing None label.
+def factorize_flow_values(flows, value_column):
+    values = flows[value_column]
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy(), np.append(values.cat.categories.to_numpy(dtype=object), None)
+    keys, others = ip_keys(flows, value_column)
+    codes, uniques = pd.factorize(keys)
+    return codes, np.array(decode_ip_keys(uniques, others) + [None], dtype=object)
+
+# Unique values grouped by port/proto
+def unique_by_port_proto(flows, port_column, value_column):
+    codes, labels = factorize_flow_values(flows, value_column)
+    unique = pd.Series(codes, index=flows.index).groupby(
+        [flows[port_column], flows['protocol']], observed=True).unique()
+    return unique.apply(lambda x: labels[x].tolist())
+
 # Extract unique sni hostnames from L7 logs. Group by port/proto. Export as a dictionary with port/proto as key and list of unique sni hostnames as value
 def process_l7_webgroup(df):
-    df = df[df['tags'].apply(lambda x: 'mitm' in x)].copy()
-    # create a new column with port_proto
-    # df['port_proto'] = df['destinationPort'].astype(str) + '_' + df['protocol']
+    df = filter_l7_logs(df)
     if len(df)>0:
-        unique_sni_hostnames = df.groupby(['destinationPort', 'protocol'])['mitmSniHostname'].unique().to_json(indent=1)
+        unique_sni_hostnames = unique_by_port_proto(df, 'destinationPort', 'mitmSniHostname').to_json(indent=1)
         return unique_sni_hostnames
     else:
         return {}
 
-# Sort heuristics for dest IPs if src_port is less than dst_port, switch src and dst ports and IPs
-
 # Extract unique dst_ips from L4 logs. Group by port/proto. Export as a dictionary with port/proto as key and list of unique dst_ips as value
 def process_l4_smartgroups(df):
-    df = df[df['tags'].apply(lambda x: 'ebpf' in x)].copy()
+    df = filter_l4_logs(df)
     if len(df)>0:
-        df['src_port'] = df['sourcePort']
-        df['dst_port'] = df['destinationPort']
-        df['src_ip'] = df['sourceIp']
-        df['dst_ip'] = df['destinationIp']
-        df.loc[df['sourcePort'] < df['destinationPort'], ['src_port', 'dst_port']] = df.loc[df['sourcePort'] < df['destinationPort'], ['dst_port', 'src_port']].values
-        df.loc[df['sourcePort'] < df['destinationPort'], ['src_ip', 'dst_ip']] = df.loc[df['sourcePort'] < df['destinationPort'], ['dst_ip', 'src_ip']].values
-        # # create a new column with port_proto
-        # df['port_proto'] = df['dst_port'].astype(str) + '_' + df['protocol']
-        unique_dst_ips = df.groupby(['dst_port', 'protocol'])['dst_ip'].unique().to_json(indent=1)
+        unique_dst_ips = unique_by_port_proto(df, 'dst_port', 'dst_ip').to_json(indent=1)
         return unique_dst_ips
     else:  
         return {}
 
+# Run both processors over a single oriented pass of the logs
+def process_dcf_logs(df):
+    flows = orient_dcf_flows(df)
+    return process_l7_webgroup(flows), process_l4_smartgroups(flows)
+
+# Request counts per value grouped by port/proto as {(port, proto): {value: count}}, values in first seen order
+def count_by_port_proto(flows, port_column, value_column):
+    if len(flows) == 0:
+        return {}
+    codes, labels = factorize_flow_values(flows, value_column)
+    counts = pd.Series(codes, index=flows.index).groupby(
+        [flows[port_column], flows['protocol'], codes], observed=True, sort=False).size()
+    groups = {}
+    for (port, proto, code), count in counts.items():
+        groups.setdefault((int(port), proto), {})[labels[code]] = int(count)
+    return groups
+
+# Merge the request counts of one page into a running {(port, proto): {value: count}} accumulator.
+# Dicts keep their insertion order so values keep their first seen order like Series.unique()
+def update_unique_groups(groups, df, port_column, value_column):
+    if len(df)>0:
+        merge_unique_groups(groups, count_by_port_proto(df, port_column, value_column))
+    return groups
+
+# Incremental versions of process_l7_webgroup and process_l4_smartgroups for a single page of logs
+def update_l7_webgroup(groups, df):
+    return update_unique_groups(groups, filter_l7_logs(df), 'destinationPort', 'mitmSniHostname')
+
+def update_l4_smartgroups(groups, df):
+    return update_unique_groups(groups, filter_l4_logs(df), 'dst_port', 'dst_ip')
+
+# Format an accumulator with the same JSON layout as the DataFrame based processors
+def format_unique_groups(groups):
+    if len(groups)>0:
+        return json.dumps({str(key): list(groups[key]) for key in sorted(groups)},
+                          indent=1, separators=(',', ':'))
+    else:
+        return {}
+
+## Parallel recommendation engine
+# The oriented flows are split into contiguous time partitions, one per process.  Each process computes the unique
+# hostname codes and destination IPs per port/proto for its partition, and the partitions are merged in order so
+# values keep their first seen order and the output matches process_dcf_logs.
+
+def group_unique_codes(flows, port_column, codes):
+    unique = pd.Series(codes, index=flows.index).groupby(
+        [flows[port_column], flows['protocol']], observed=True).unique()
+    return {(int(port), proto): values for (port, proto), values in unique.items()}
+
+# Runs in a worker process for a single partition of oriented flows
+def unique_codes_by_port_proto(flows):
+    l7 = filter_l7_logs(flows)
+    l4 = filter_l4_logs(flows)
+    return (group_unique_codes(l7, 'destinationPort', l7['mitmSniHostname'].cat.codes.to_numpy()),
+            group_unique_codes(l4, 'dst_port', ip_keys(l4, 'dst_ip')[0]))
+
+def merge_unique_codes(partitions):
+    merged = {}
+    for partition in partitions:
+        for key, values in partition.items():
+            merged.setdefault(key, []).append(values)
+    return {key: pd.unique(np.concatenate(values)) for key, values in merged.items()}
+
+def process_dcf_logs_parallel(df, processes):
+    flows = orient_dcf_flows(df)
+    if len(flows) == 0:
+        return {}, {}
+    boundaries = np.linspace(0, len(flows), processes + 1).astype(int)
+    partitions = [flows.iloc[boundaries[i]:boundaries[i+1]] for i in range(processes)]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = list(executor.map(unique_codes_by_port_proto, partitions))
+
+    # Missing hostnames have the code -1, which picks the trailing None label
+    hostnames = np.append(flows['mitmSniHostname'].cat.categories.to_numpy(dtype=object), None)
+    web_groups = {key: hostnames[codes].tolist()
+                  for key, codes in merge_unique_codes([x[0] for x in results]).items()}
+    others = ip_keys(flows.iloc[:0], 'dst_ip')[1]
+    smart_groups = {key: decode_ip_keys(ips, others)
+                    for key, ips in merge_unique_codes([x[1] for x in results]).items()}
+    return format_unique_groups(web_groups), format_unique_groups(smart_groups)
+
+# Consume pages of logs one at a time, keeping only the request counts per unique value and port/proto
+def accumulate_dcf_log_pages(pages):
+    web_groups = {}
+    smart_groups = {}
+    count = 0
+    for page in pages:
+        page_df = orient_dcf_flows(pd.DataFrame(page))
+        update_l7_webgroup(web_groups, page_df)
+        update_l4_smartgroups(smart_groups, page_df)
+        count += len(page)
+    logging.info("Number of Logs Indexed: {}".format(count))
+    return web_groups, smart_groups
+
+def process_dcf_log_pages(pages):
+    web_groups, smart_groups = accumulate_dcf_log_pages(pages)
+    return format_unique_groups(web_groups), format_unique_groups(smart_groups)
+
+## Flow summaries
+# The request count accumulators can be saved as a JSON summary and merged with the summaries of other runs or
+# gateways.  A summary only holds the distinct (port, proto, value) tuples and their counts:
+# {"version": 1, "web_groups": [{"port": 443, "protocol": "TCP", "counts": [["example.com", 12], ...]}, ...],
+#  "smart_groups": [{"port": 22, "protocol": "TCP", "counts": [["52.1.2.3", 3], ...]}, ...]}
+# Counts are lists of pairs so values keep their first seen order and hostnames may be null.
+DCF_LOG_SUMMARY_VERSION = 1
+
+def dump_unique_groups(groups):
+    return [{"port": port, "protocol": proto, "counts": [[value, count] for value, count in groups[(port, proto)].items()]}
+            for port, proto in groups]
+
+def load_unique_groups(groups):
+    return {(int(x["port"]), x["protocol"]): {value: int(count) for value, count in x["counts"]} for x in groups}
+
+def save_dcf_log_summary(filename, web_groups, smart_groups):
+    summary = {
+        "version": DCF_LOG_SUMMARY_VERSION,
+        "web_groups": dump_unique_groups(web_groups),
+        "smart_groups": dump_unique_groups(smart_groups)
+    }
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(summary, f, separators=(',', ':'))
+    os.replace(filename + '.tmp', filename)
+
+def load_dcf_log_summary(filename):
+    with open(filename) as f:
+        summary = json.load(f)
+    if summary.get("version") != DCF_LOG_SUMMARY_VERSION:
+        raise ValueError("Unsupported summary version {} in {}".format(summary.get("version"), filename))
+    return load_unique_groups(summary["web_groups"]), load_unique_groups(summary["smart_groups"])
+
+# Add the request counts of another accumulator, values new to a port/proto are appended after the existing ones
+def merge_unique_groups(groups, other):
+    for key, counts in other.items():
+        group = groups.setdefault(key, {})
+        for value, count in counts.items():
+            group[value] = group.get(value, 0) + count
+    return groups
+
+## Sketch analysis
+# For long windows the exact unique sets are replaced with fixed size sketches per port/proto:
+#  - a HyperLogLog of 2**precision one byte registers for the approximate number of distinct values
+#  - a Space-Saving table of the values with the most requests.  Each entry is [count, error] where count
+#    overestimates the requests by at most error.  The table tracks SPACE_SAVING_SLACK times top_k values so the
+#    reported top_k are not crowded out by evicted tail values.
+# Memory per port/proto does not depend on the window length.  Sketches of shards or time partitions are merged by
+# taking the register maximum and combining the Space-Saving tables, and can be saved and merged across runs.
+# Values are hashed with the fixed key pandas hash, so hashes are the same in every process and run.
+DCF_LOG_SKETCH_VERSION = 1
+SKETCH_PRECISION = 12
+SKETCH_TOP_K = 20
+SPACE_SAVING_SLACK = 4
+
+def new_sketch(precision):
+    return {"registers": np.zeros(2**precision, dtype=np.uint8), "top": {}}
+
+# Set the register of each hash to the largest rank seen, the rank is the position of the lowest set bit of the
+# hash above the register index bits
+def hll_add(registers, hashes):
+    precision = int(np.log2(len(registers)))
+    index = (hashes & np.uint64(len(registers) - 1)).astype(np.int64)
+    rest = hashes >> np.uint64(precision)
+    lowest = rest & (~rest + np.uint64(1))
+    rank = np.where(rest == 0, 64 - precision + 1, np.log2(lowest.astype(np.float64)).astype(np.int64) + 1)
+    np.maximum.at(registers, index, rank.astype(np.uint8))
+
+def hll_estimate(registers):
+    m = len(registers)
+    alpha = 0.7213/(1 + 1.079/m)
+    estimate = alpha*m*m/np.sum(np.exp2(-registers.astype(np.float64)))
+    # Small range correction
+    zeros = np.count_nonzero(registers == 0)
+    if estimate <= 2.5*m and zeros > 0:
+        estimate = m*np.log(m/zeros)
+    return int(round(estimate))
+
+# Add the exact request counts of one chunk to a Space-Saving table.  The chunk becomes a table of its capacity
+# heaviest values with no error, selected without sorting the whole chunk, and is merged into the running table.
+# The values left out of a full chunk table had at most its smallest count, which the merge accounts for.
+def space_saving_add(top, values, counts, capacity):
+    keep = np.arange(len(counts))
+    if len(counts) > capacity:
+        keep = np.argpartition(-counts, capacity - 1)[:capacity]
+    keep = keep[np.argsort(-counts[keep], kind='stable')]
+    return merge_space_saving(top, {values[i]: [int(counts[i]), 0] for i in keep}, capacity)
+
+# A value missing from a full table may have had up to the table minimum requests
+def merge_space_saving(top, other, capacity):
+    top_min = min(x[0] for x in top.values()) if len(top) >= capacity else 0
+    other_min = min(x[0] for x in other.values()) if len(other) >= capacity else 0
+    merged = {}
+    for value in list(top) + [x for x in other if x not in top]:
+        count, error = top.get(value, [top_min, top_min])
+        other_count, other_error = other.get(value, [other_min, other_min])
+        merged[value] = [count + other_count, error + other_error]
+    return dict(sorted(merged.items(), key=lambda x: -x[1][0])[:capacity])
+
+# Fold the values of oriented flows into the sketches of their port/proto.  Each distinct value is hashed once.
+def update_sketches(sketches, flows, port_column, value_column, precision=SKETCH_PRECISION, top_k=SKETCH_TOP_K):
+    if len(flows) == 0:
+        return sketches
+    codes, labels = factorize_flow_values(flows, value_column)
+    hashes = pd.util.hash_array(labels, categorize=False)
+    counts = pd.Series(codes, index=flows.index).groupby(
+        [flows[port_column], flows['protocol'], codes], observed=True, sort=False).size()
+    ports = counts.index.get_level_values(0).to_numpy()
+    protocols = counts.index.get_level_values(1).to_numpy()
+    # Missing values have the code -1, which picks the trailing None label
+    value_codes = counts.index.get_level_values(2).to_numpy()
+    value_counts = counts.to_numpy()
+    keys = pd.Series(np.arange(len(counts))).groupby([ports, protocols], sort=False).indices
+    for (port, proto), positions in keys.items():
+        sketch = sketches.setdefault((int(port), proto), new_sketch(precision))
+        hll_add(sketch["registers"], hashes[value_codes[positions]])
+        sketch["top"] = space_saving_add(sketch["top"], labels[value_codes[positions]], value_counts[positions],
+                                         top_k*SPACE_SAVING_SLACK)
+    return sketches
+
+def merge_sketches(sketches, other, top_k=SKETCH_TOP_K):
+    for key, sketch in other.items():
+        if key not in sketches:
+            sketches[key] = {"registers": sketch["registers"].copy(), "top": dict(sketch["top"])}
+            continue
+        if len(sketches[key]["registers"]) != len(sketch["registers"]):
+            raise ValueError("Sketches with different precisions can not be merged")
+        np.maximum(sketches[key]["registers"], sketch["registers"], out=sketches[key]["registers"])
+        sketches[key]["top"] = merge_space_saving(sketches[key]["top"], sketch["top"], top_k*SPACE_SAVING_SLACK)
+    return sketches
+
+# Sketch versions of the L7 and L4 processors
+def sketch_dcf_logs(df, precision=SKETCH_PRECISION, top_k=SKETCH_TOP_K):
+    flows = orient_dcf_flows(df)
+    return (update_sketches({}, filter_l7_logs(flows), 'destinationPort', 'mitmSniHostname', precision, top_k),
+            update_sketches({}, filter_l4_logs(flows), 'dst_port', 'dst_ip', precision, top_k))
+
+def sketch_dcf_logs_parallel(df, processes, precision=SKETCH_PRECISION, top_k=SKETCH_TOP_K):
+    flows = orient_dcf_flows(df)
+    if len(flows) == 0:
+        return {}, {}
+    boundaries = np.linspace(0, len(flows), processes + 1).astype(int)
+    partitions = [flows.iloc[boundaries[i]:boundaries[i+1]] for i in range(processes)]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = list(executor.map(sketch_dcf_logs, partitions, [precision]*processes, [top_k]*processes))
+    web_groups, smart_groups = {}, {}
+    for partition_web_groups, partition_smart_groups in results:
+        merge_sketches(web_groups, partition_web_groups, top_k)
+        merge_sketches(smart_groups, partition_smart_groups, top_k)
+    return web_groups, smart_groups
+
+# Consume pages of logs one at a time, keeping only the sketches per port/proto
+def accumulate_dcf_log_sketches(pages, precision=SKETCH_PRECISION, top_k=SKETCH_TOP_K):
+    web_groups = {}
+    smart_groups = {}
+    count = 0
+    for page in pages:
+        page_df = orient_dcf_flows(pd.DataFrame(page))
+        update_sketches(web_groups, filter_l7_logs(page_df), 'destinationPort', 'mitmSniHostname', precision, top_k)
+        update_sketches(smart_groups, filter_l4_logs(page_df), 'dst_port', 'dst_ip', precision, top_k)
+        count += len(page)
+    logging.info("Number of Logs Indexed: {}".format(count))
+    return web_groups, smart_groups
+
+def dump_sketches(sketches):
+    return [{"port": port, "protocol": proto,
+             "registers": base64.b64encode(sketch["registers"].tobytes()).decode(),
+             "top": [[value, count, error] for value, (count, error) in sketch["top"].items()]}
+            for (port, proto), sketch in sketches.items()]
+
+def load_sketches(sketches):
+    return {(int(x["port"]), x["protocol"]): {
+                "registers": np.frombuffer(base64.b64decode(x["registers"]), dtype=np.uint8).copy(),
+                "top": {value: [int(count), int(error)] for value, count, error in x["top"]}}
+            for x in sketches}
+
+def save_dcf_log_sketches(filename, web_groups, smart_groups):
+    sketches = {
+        "version": DCF_LOG_SKETCH_VERSION,
+        "web_groups": dump_sketches(web_groups),
+        "smart_groups": dump_sketches(smart_groups)
+    }
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(sketches, f, separators=(',', ':'))
+    os.replace(filename + '.tmp', filename)
+
+def load_dcf_log_sketches(filename):
+    with open(filename) as f:
+        sketches = json.load(f)
+    if sketches.get("version") != DCF_LOG_SKETCH_VERSION:
+        raise ValueError("Unsupported sketch version {} in {}".format(sketches.get("version"), filename))
+    return load_sketches(sketches["web_groups"]), load_sketches(sketches["smart_groups"])
+
+# Approximate distinct count and top_k values with [count, error] per port/proto, in the port/proto order of the
+# exact output
+def format_sketches(sketches, top_k=SKETCH_TOP_K):
+    if len(sketches)>0:
+        return json.dumps({str(key): {"distinct": hll_estimate(sketches[key]["registers"]),
+                                      "top": [[value, count, error] for value, (count, error)
+                                              in sorted(sketches[key]["top"].items(), key=lambda x: -x[1][0])[:top_k]]}
+                           for key in sorted(sketches)}, indent=1, separators=(',', ':'))
+    else:
+        return {}
+
+## WebGroup wildcard proposals
+# SNI hostnames are inserted into a trie keyed on their labels in reverse order (com -> example -> www).  When a
+# node at least min_labels deep has fanout_threshold or more child labels, its whole subtree is proposed as a
+# single "*.<domain>" entry instead of the individual hostnames.  Each proposed entry reports the number of requests
+# it covers and its share of the requests for the port/proto.
+
+def build_domain_trie(hostname_counts):
+    root = {'children': {}, 'requests': 0, 'total': 0, 'hostnames': 0}
+    for hostname, count in hostname_counts.items():
+        if not hostname:
+            continue
+        node = root
+        node['total'] += count
+        node['hostnames'] += 1
+        for label in reversed(hostname.lower().rstrip('.').split('.')):
+            node = node['children'].setdefault(label, {'children': {}, 'requests': 0, 'total': 0, 'hostnames': 0})
+            node['total'] += count
+            node['hostnames'] += 1
+        node['requests'] += count
+    return root
+
+def collapse_domain_trie(node, labels, fanout_threshold, min_labels, entries):
+    for label, child in node['children'].items():
+        domain = '.'.join([label] + labels)
+        # A wildcard only matches subdomains, so requests for the domain itself stay a separate entry
+        if child['requests'] > 0:
+            entries.append((domain, child['requests'], 1))
+        if len(labels) + 1 >= min_labels and len(child['children']) >= fanout_threshold:
+            entries.append(('*.' + domain, child['total'] - child['requests'],
+                            child['hostnames'] - (1 if child['requests'] > 0 else 0)))
+        else:
+            collapse_domain_trie(child, [label] + labels, fanout_threshold, min_labels, entries)
+    return entries
+
+# Propose WebGroup domains per port/proto from {(port, proto): {hostname: requests}}, most requested first
+def propose_webgroup_wildcards(web_groups, fanout_threshold, min_labels=2):
+    if len(web_groups) == 0:
+        return {}
+    proposals = {}
+    for key in sorted(web_groups):
+        trie = build_domain_trie(web_groups[key])
+        entries = collapse_domain_trie(trie, [], fanout_threshold, min_labels, [])
+        entries.sort(key=lambda x: (-x[1], x[0]))
+        proposals[str(key)] = [{"domain": domain, "requests": requests,
+                                "coverage": round(requests/trie['total'], 4) if trie['total'] > 0 else 0,
+                                "hostnames": hostnames}
+                               for domain, requests, hostnames in entries]
+    return json.dumps(proposals, indent=1, separators=(',', ':'))
+
+## CIDR aggregation
+# Prefixes are held as (network int, prefix length) nodes of a binary prefix tree.  The tree is walked one level
+# at a time from the longest prefix up, and at each level sibling subtrees are merged into their parent when the
+# addresses the parent covers without them being seen fit in the remaining over-coverage budget.  Merges that
+# cover the fewest unseen addresses per removed prefix are taken first.  With a budget of 0 only fully covered
+# parents are merged, which is a lossless collapse.  IPv6 addresses are only collapsed losslessly.
+
+def aggregate_cidrs(cidrs, max_prefix_length=32, min_prefix_length=16, max_overcoverage=0):
+    networks = []
+    ipv6_networks = []
+    for cidr in cidrs:
+        network = ipaddress.ip_network(cidr, strict=False)
+        if network.version != 4:
+            ipv6_networks.append(network)
+            continue
+        if network.prefixlen > max_prefix_length:
+            network = network.supernet(new_prefix=max_prefix_length)
+        networks.append(network)
+    prefixes = {(int(x.network_address), x.prefixlen) for x in ipaddress.collapse_addresses(networks)}
+
+    budget = max_overcoverage
+    for level in range(max_prefix_length - 1, min_prefix_length - 1, -1):
+        children = {}
+        for network, length in prefixes:
+            if length > level:
+                children.setdefault(network >> (32 - level), []).append((network, length))
+        candidates = []
+        for parent, members in children.items():
+            if len(members) < 2:
+                continue
+            overcoverage = 2**(32 - level) - sum(2**(32 - length) for _, length in members)
+            candidates.append((overcoverage/(len(members) - 1), overcoverage, parent, members))
+        candidates.sort()
+        for _, overcoverage, parent, members in candidates:
+            if overcoverage > budget:
+                continue
+            budget -= overcoverage
+            prefixes.difference_update(members)
+            prefixes.add((parent << (32 - level), level))
+
+    return ([format_cidr(ipaddress.ip_network(x)) for x in sorted(prefixes)] +
+            [format_cidr(x) for x in ipaddress.collapse_addresses(ipv6_networks)])
+
+# Host routes are kept as plain addresses, like the IPs in the unaggregated recommendations
+def format_cidr(network):
+    if network.num_addresses == 1:
+        return str(network.network_address)
+    return str(network)
+
+# Aggregate the dst IPs of each Port/Proto in the process_l4_smartgroups JSON
+def aggregate_smartgroup_recommendations(unique_dst_ips, max_prefix_length=32, min_prefix_length=16,
+                                         max_overcoverage=0):
+    if len(unique_dst_ips) == 0:
+        return unique_dst_ips
+    groups = json.loads(unique_dst_ips)
+    aggregated = {key: aggregate_cidrs(ips, max_prefix_length, min_prefix_length, max_overcoverage)
+                  for key, ips in groups.items()}
+    return json.dumps(aggregated, indent=1, separators=(',', ':'))
+
+## Offline rule evaluation
+# The logs are replayed through a policy list in priority order, each log counting against the first rule it
+# matches.  Rows are first collapsed into distinct (src, dst, port, proto, SNI) flows with their row counts and
+# every match is precompiled over the distinct values of one field:
+#  - SmartGroups become sorted, disjoint address ranges of their collapsed CIDRs, a flattened prefix trie that is
+#    looked up with a binary search over the distinct IPs
+#  - port ranges and protocols are matched once per distinct (port, proto) bucket
+#  - WebGroup SNI filters are matched against the suffixes of each distinct hostname
+# A rule then only touches the flows no higher priority rule has matched.
+
+ANYWHERE_SMARTGROUP_ID = "def000ad-0000-0000-0000-000000000000"
+INTERNET_SMARTGROUP_ID = "def000ad-0000-0000-0000-000000000001"
+PRIVATE_IPV4_CIDRS = ['10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16']
+
+# Read a JSON file holding either a list or an object with the list under key
+def load_json_list(filename, key):
+    with open(filename) as f:
+        data = json.load(f)
+    return data[key] if isinstance(data, dict) else data
+
+def get_policy_list(controller_ip, cid):
+    headers = {
+        "Authorization": "cid {}".format(cid)
+    }
+    response = get_controller_session().get("https://{}/v2.5/api/microseg/policy-list".format(
+        controller_ip), headers=headers, verify=False)
+    return response.json()['policies']
+
+def get_app_domains(controller_ip, cid):
+    headers = {
+        "Authorization": "cid {}".format(cid)
+    }
+    response = get_controller_session().get("https://{}/v2.5/api/app-domains".format(
+        controller_ip), headers=headers, verify=False)
+    return response.json()['app_domains']
+
+# Sorted disjoint [start, end] address ranges of a list of IPv4 CIDRs
+def build_cidr_index(cidrs):
+    networks = [ipaddress.ip_network(x, strict=False) for x in cidrs]
+    networks = list(ipaddress.collapse_addresses([x for x in networks if x.version == 4]))
+    starts = np.array([int(x.network_address) for x in networks], dtype=np.int64)
+    ends = np.array([int(x.broadcast_address) for x in networks], dtype=np.int64)
+    return starts, ends
+
+def match_cidr_index(index, ips):
+    starts, ends = index
+    if len(starts) == 0:
+        return np.zeros(len(ips), dtype=bool)
+    ips = np.asarray(ips, dtype=np.int64)
+    position = np.searchsorted(starts, ips, side='right') - 1
+    return (position >= 0) & (ips <= ends[np.maximum(position, 0)])
+
+# Membership of the distinct IPs in a SmartGroup.  Only CIDR selectors can be evaluated from logs, other selector
+# terms never match.  IPs that are not IPv4 are stored as 0 and only match Anywhere, IPv6 CIDRs are not evaluated.
+def match_smartgroup(uuid, smartgroups, ips):
+    if uuid == ANYWHERE_SMARTGROUP_ID:
+        return np.ones(len(ips), dtype=bool)
+    if uuid == INTERNET_SMARTGROUP_ID:
+        return ~match_cidr_index(build_cidr_index(PRIVATE_IPV4_CIDRS), ips) & (np.asarray(ips) != 0)
+    smartgroup = smartgroups.get(uuid)
+    if smartgroup is None:
+        logging.warning("Unknown SmartGroup {}".format(uuid))
+        return np.zeros(len(ips), dtype=bool)
+    terms = [x.get('all', {}) for x in smartgroup.get('selector', {}).get('any', [])]
+    cidrs = [x['cidr'] for x in terms if 'cidr' in x]
+    if len(cidrs) < len(terms):
+        logging.warning("SmartGroup {} has non CIDR selectors that are not evaluated".format(smartgroup.get('name')))
+    return match_cidr_index(build_cidr_index(cidrs), ips) & (np.asarray(ips) != 0)
+
+# Exact domains and wildcard suffixes of a list of SNI filters.  "*.example.com" matches subdomains only.
+def build_domain_index(filters):
+    exact, wildcards = set(), set()
+    for x in filters:
+        x = x.lower().rstrip('.')
+        if x == '*':
+            wildcards.add('')
+        elif x.startswith('*.'):
+            wildcards.add(x[2:])
+        else:
+            exact.add(x)
+    return exact, wildcards
+
+def match_domain_index(index, hostname):
+    exact, wildcards = index
+    if not hostname:
+        return False
+    hostname = hostname.lower().rstrip('.')
+    if hostname in exact or '' in wildcards:
+        return True
+    labels = hostname.split('.')
+    return any('.'.join(labels[i:]) in wildcards for i in range(1, len(labels)))
+
+# Membership of the distinct hostnames in the union of some WebGroups, with a trailing False for logs without SNI
+def match_webgroups(uuids, webgroups, hostnames):
+    filters = []
+    for uuid in uuids:
+        if uuid not in webgroups:
+            logging.warning("Unknown WebGroup {}".format(uuid))
+            continue
+        filters += [x['all']['snifilter'] for x in webgroups[uuid].get('selector', {}).get('any', [])
+                    if 'snifilter' in x.get('all', {})]
+    index = build_domain_index(filters)
+    return np.array([match_domain_index(index, x) for x in hostnames] + [False], dtype=bool)
+
+# Whether each distinct (port, proto) bucket is allowed by a rule.  An empty port range list allows any port and
+# PROTOCOL_UNSPECIFIED or ANY allows any protocol.
+def match_port_proto(rule, ports, protocols):
+    protocol = str(rule.get('protocol', 'PROTOCOL_UNSPECIFIED')).upper()
+    allowed = np.ones(len(ports), dtype=bool)
+    if protocol not in ('PROTOCOL_UNSPECIFIED', 'ANY'):
+        allowed &= np.array([str(x).upper() == protocol for x in protocols], dtype=bool)
+    port_ranges = rule.get('port_ranges') or []
+    if len(port_ranges) > 0:
+        in_range = np.zeros(len(ports), dtype=bool)
+        for port_range in port_ranges:
+            lo = int(port_range.get('lo', 0))
+            hi = int(port_range.get('hi') or lo)
+            in_range |= (ports >= lo) & (ports <= hi)
+        allowed &= in_range
+    return allowed
+
+# Collapse normalized logs into distinct flows oriented like the recommendation processors.  Returns the row count
+# of each flow and, for each field, the distinct values and the code of every flow into them.
+def collapse_dcf_flows(df):
+    df = normalize_dcf_logs(df)
+    flags = df['tag_flags'].to_numpy()
+    source_ip, destination_ip = df['sourceIp'].to_numpy(), df['destinationIp'].to_numpy()
+    source_port, destination_port = df['sourcePort'].to_numpy(), df['destinationPort'].to_numpy()
+    # L4 logs may be seen in the reverse direction, L7 logs are always client to server
+    swap = ((flags & TAG_MITM) == 0) & (source_port < destination_port)
+    protocols = df['protocol'].astype('category')
+    # Logs without a protocol have the code -1, which is mapped to the trailing None protocol
+    protocol_values = np.append(protocols.cat.categories.to_numpy(dtype=object), None)
+    protocol_codes = protocols.cat.codes.to_numpy().astype(np.int64)
+    protocol_codes[protocol_codes < 0] = len(protocol_values) - 1
+    if 'mitmSniHostname' in df.columns:
+        hostnames = df['mitmSniHostname'].astype('category')
+        hostname_codes, hostname_values = hostnames.cat.codes.to_numpy(), hostnames.cat.categories.to_numpy(dtype=object)
+    else:
+        hostname_codes, hostname_values = np.full(len(df), -1), np.array([], dtype=object)
+
+    counts = pd.DataFrame({
+        'src': np.where(swap, destination_ip, source_ip),
+        'dst': np.where(swap, source_ip, destination_ip),
+        'port': np.where(swap, source_port, destination_port).astype(np.int64),
+        'proto': protocol_codes,
+        'sni': hostname_codes,
+    }).value_counts(sort=False)
+    flows = counts.index.to_frame(index=False)
+
+    src_values, src_codes = np.unique(flows['src'].to_numpy(), return_inverse=True)
+    dst_values, dst_codes = np.unique(flows['dst'].to_numpy(), return_inverse=True)
+    buckets = flows['port'].to_numpy() * len(protocol_values) + flows['proto'].to_numpy()
+    bucket_values, bucket_codes = np.unique(buckets, return_inverse=True)
+    sni_codes = flows['sni'].to_numpy()
+    return {
+        'counts': counts.to_numpy(),
+        'src': (src_values, src_codes),
+        'dst': (dst_values, dst_codes),
+        'port_proto': (bucket_values // len(protocol_values), protocol_values[bucket_values % len(protocol_values)],
+                       bucket_codes),
+        # Logs without SNI have the code -1, which picks the trailing False of the WebGroup matches
+        'sni': (hostname_values, np.where(sni_codes < 0, len(hostname_values), sni_codes)),
+    }
+
+# Replay the logs through the policy list plus the proposed rules in priority order and count the logs each rule
+# matches first.  Rules are DCF rules as returned by microseg/policy-list, referring to SmartGroups and WebGroups
+# from app-domains.  Missing src_ads or dst_ads match anything.
+def evaluate_policy_rules(df, policies, app_domains, proposed_rules=[]):
+    rules = [dict(x, proposed=False) for x in policies] + [dict(x, proposed=True) for x in proposed_rules]
+    rules.sort(key=lambda x: x.get('priority', 0))
+    by_uuid = {x['uuid']: x for x in app_domains}
+
+    hits = [0] * len(rules)
+    total = 0
+    if len(df) > 0:
+        flows = collapse_dcf_flows(df)
+        counts = flows['counts']
+        total = int(counts.sum())
+        src_values, src_codes = flows['src']
+        dst_values, dst_codes = flows['dst']
+        ports, protocols, bucket_codes = flows['port_proto']
+        hostnames, sni_codes = flows['sni']
+
+        # SmartGroups shared by several rules are matched once
+        src_matches, dst_matches = {}, {}
+        def match_ads(uuids, matches, values):
+            if not uuids:
+                uuids = [ANYWHERE_SMARTGROUP_ID]
+            allowed = np.zeros(len(values), dtype=bool)
+            for uuid in uuids:
+                if uuid not in matches:
+                    matches[uuid] = match_smartgroup(uuid, by_uuid, values)
+                allowed |= matches[uuid]
+            return allowed
+
+        remaining = np.arange(len(counts))
+        for i, rule in enumerate(rules):
+            if len(remaining) == 0:
+                break
+            matched = match_port_proto(rule, ports, protocols)[bucket_codes[remaining]]
+            matched &= match_ads(rule.get('src_ads'), src_matches, src_values)[src_codes[remaining]]
+            matched &= match_ads(rule.get('dst_ads'), dst_matches, dst_values)[dst_codes[remaining]]
+            web_groups = rule.get('web_groups') or rule.get('web_filters') or []
+            if len(web_groups) > 0:
+                matched &= match_webgroups(web_groups, by_uuid, hostnames)[sni_codes[remaining]]
+            hits[i] = int(counts[remaining[matched]].sum())
+            remaining = remaining[~matched]
+
+    permitted = sum(x for x, rule in zip(hits, rules) if 'PERMIT' in str(rule.get('action', '')).upper())
+    denied = sum(hits) - permitted
+    result = {
+        'total': total,
+        'permitted': permitted,
+        'denied': denied,
+        'unmatched': total - permitted - denied,
+        'permitted_share': round(permitted/total, 4) if total > 0 else 0,
+        'rules': [{'priority': rule.get('priority'), 'name': rule.get('name'), 'uuid': rule.get('uuid'),
+                   'action': rule.get('action'), 'proposed': rule['proposed'], 'hits': count,
+                   'share': round(count/total, 4) if total > 0 else 0}
+                  for rule, count in zip(rules, hits)],
+    }
+    return json.dumps(result, indent=1, separators=(',', ':'))
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,51 @@
+# Unit tests for the policy evaluation of the egress policy recommendation script.
+# Run from the repository root with "python3 -m pytest egress_policy_recommendation/tests"
+import importlib.util
+import json
+import os
+import unittest
+from collections import Counter
+
+import pandas as pd
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "egress_policy_recommendation.py")
+spec = importlib.util.spec_from_file_location("egress_policy_recommendation", SCRIPT)
+epr = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(epr)
+
+def build_logs(protocols):
+    count = len(protocols)
+    return pd.DataFrame({
+        "sourceIp": ["10.0.0.{}".format(i + 1) for i in range(count)],
+        "destinationIp": ["192.0.2.{}".format(i + 1) for i in range(count)],
+        "sourcePort": [40000 + i for i in range(count)],
+        "destinationPort": [443] * count,
+        "protocol": protocols,
+        "action": ["PERMIT"] * count,
+        "tags": [[] for _ in range(count)],
+    })
+
+
+class CollapseDcfFlowsTest(unittest.TestCase):
+    def test_null_protocol_gets_its_own_bucket(self):
+        flows = epr.collapse_dcf_flows(build_logs(["TCP", None, "UDP", None]))
+        ports, protocols, bucket_codes = flows["port_proto"]
+        self.assertEqual(Counter(zip(ports.tolist(), protocols.tolist())), Counter([(443, "TCP"), (443, "UDP"), (443, None)]))
+        self.assertEqual(Counter(protocols[bucket_codes].tolist()), Counter(["TCP", "UDP", None, None]))
+
+    def test_only_null_protocols(self):
+        ports, protocols, bucket_codes = epr.collapse_dcf_flows(build_logs([None, None]))["port_proto"]
+        self.assertEqual((ports.tolist(), protocols.tolist(), bucket_codes.tolist()), ([443], [None], [0, 0]))
+
+
+class EvaluatePolicyRulesTest(unittest.TestCase):
+    def test_null_protocol_only_matches_any_protocol(self):
+        policies = [{"uuid": "tcp", "priority": 1, "action": "PERMIT", "protocol": "TCP"},
+                    {"uuid": "any", "priority": 2, "action": "DENY", "protocol": "PROTOCOL_UNSPECIFIED"}]
+        result = json.loads(epr.evaluate_policy_rules(build_logs(["TCP", None, "UDP"]), policies, []))
+        self.assertEqual(result["total"], 3)
+        self.assertEqual([x["hits"] for x in result["rules"]], [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,17 +1,21 @@
 ## Shell script to install the required pip dependencies for the lambda function "example.py"
+# Repository root holding the shared controller client
+REPO_ROOT="$(cd "$(dirname "$0")/../.." && pwd)"
+
 # Set up a virtual environment
 virtualenv venv
 source venv/bin/activate
 
-# Install the required dependencies - requests and pydig
+# Install the required dependencies - requests and dnspython
 pip install requests
-pip install pydig
+pip install dnspython
 
 # Make temp lambda_package directory
 mkdir lambda_package
 
-# Copy the function.py file to the lambda_package directory
+# Copy the function.py file and the shared controller client to the lambda_package directory
 cp function.py lambda_package
+cp "$REPO_ROOT/aviatrix_client.py" lambda_package
 
 # Copy the installed packages and subdirectories to the lambda_package directory
 cp -r venv/lib/python3.10/site-packages/* lambda_package
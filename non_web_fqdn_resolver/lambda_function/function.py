@@ -1,14 +1,26 @@
 # Import necessary libraries
 import json
 import os
-import requests
+import sys
+import time
 import logging
-import pydig
+import ipaddress
+import asyncio
+import dns.asyncresolver
+import dns.exception
+import dns.name
+import dns.resolver
 
 # Disable certificate warnings
 import urllib3
 urllib3.disable_warnings()
 
+# Shared controller API client, packaged next to this file in Lambda archives
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from aviatrix_client import login, get_controller_session, acquire_controller_token, run_concurrent_updates, \
+    get_app_domains, get_app_domains_by_prefix, invalidate_app_domains, get_selector_cidrs, same_cidrs, summarize_results, \
+    aggregate_cidrs
+
 logging.basicConfig(level=logging.INFO)
 
 # Main event handler function
@@ -23,9 +35,17 @@ def handler(event, context):
 
     result = get_fqdn_smartgroups(os.getenv("AVIATRIX_CONTROLLER_IP"), cid)
 
-    updated_groups = []
-    for smartgroup in result:
-        updated_groups.append(update_fqdn_smartgroup_cidrs(os.getenv("AVIATRIX_CONTROLLER_IP"), smartgroup, cid))
+    # Resolve every FQDN concurrently before updating the SmartGroups
+    resolved = lookup_fqdn_ips([get_smartgroup_fqdn(x) for x in result])
+
+    def update(smartgroup):
+        fqdn = get_smartgroup_fqdn(smartgroup)
+        # Leave the SmartGroup unchanged when the lookup failed rather than emptying it
+        if resolved[fqdn] is None:
+            return {"result": "Failed DNS lookup for {}".format(fqdn), "status": "failed"}
+        return update_fqdn_smartgroup_cidrs(os.getenv("AVIATRIX_CONTROLLER_IP"), smartgroup, cid, resolved[fqdn])
+
+    updated_groups = run_concurrent_updates(update, result)
 
     # Format and return the response
     response = {
@@ -33,50 +53,93 @@ def handler(event, context):
         "headers": {
             "Content-Type": "application/json"
         },
-        "body": json.dumps(updated_groups)
+        "body": json.dumps(dict(summarize_results(updated_groups), results=updated_groups))
     }
 
     return response
 
-def login(controller_ip, controller_user, controller_password):
-    # URL for the controller API
-    url = "https://{}/v2/api".format(controller_ip)
-    # Payload to send for login
-    payload = {'action': 'login',
-               'username': controller_user,
-               'password': controller_password}
-
-    headers = {}
-
-    # Make a POST request to the URL with the payload
-    response = requests.post(url, headers=headers, data=payload, verify=False)
-
-    # Return the CID from the response
-    return response.json()["CID"]
+# DNS resolver - lookups run concurrently in process and answers are cached for their TTL across warm Lambda invocations
+DNS_CONCURRENCY = int(os.getenv("DNS_CONCURRENCY", "20"))
+DNS_TIMEOUT = float(os.getenv("DNS_TIMEOUT", "5"))
+DNS_NEGATIVE_TTL = int(os.getenv("DNS_NEGATIVE_TTL", "60"))
+MAX_CNAME_DEPTH = 8
+dns_cache = {}
 
 # Lookup FQDN IP
 def lookup_fqdn_ip(fqdn):
-    return pydig.query(fqdn, 'A')
+    return lookup_fqdn_ips([fqdn])[fqdn]
+
+# Lookup the IPs of a list of FQDNs.  Returns a dict of FQDN to IP list, or None when the lookup failed.
+def lookup_fqdn_ips(fqdns):
+    return asyncio.run(resolve_fqdns(list(dict.fromkeys(fqdns))))
+
+async def resolve_fqdns(fqdns):
+    resolver = dns.asyncresolver.Resolver()
+    semaphore = asyncio.Semaphore(DNS_CONCURRENCY)
+    ips = await asyncio.gather(*[resolve_fqdn_ip(resolver, semaphore, x) for x in fqdns])
+    return dict(zip(fqdns, ips))
+
+# Resolve the A records of an FQDN, following the CNAME chain.  The answer is cached until the lowest TTL in the chain expires.
+async def resolve_fqdn_ip(resolver, semaphore, fqdn):
+    cached = dns_cache.get(fqdn)
+    if cached and cached["expires"] > time.time():
+        logging.debug("DNS cache hit: {} {}".format(fqdn, cached["ips"]))
+        return cached["ips"]
+
+    name = fqdn
+    ttl = None
+    async with semaphore:
+        for _ in range(MAX_CNAME_DEPTH):
+            try:
+                answer = await resolver.resolve(name, 'A', lifetime=DNS_TIMEOUT)
+            except dns.resolver.NoAnswer as e:
+                # The server returned only part of a CNAME chain, continue from the last name it gave
+                chain = e.response().resolve_chaining()
+                if chain.canonical_name == dns.name.from_text(name):
+                    ips, ttl = [], min(ttl or DNS_NEGATIVE_TTL, DNS_NEGATIVE_TTL)
+                    break
+                logging.debug("Following CNAME: {} -> {}".format(name, chain.canonical_name))
+                ttl = chain.minimum_ttl if ttl is None else min(ttl, chain.minimum_ttl)
+                name = chain.canonical_name.to_text()
+                continue
+            except dns.resolver.NXDOMAIN:
+                ips, ttl = [], min(ttl or DNS_NEGATIVE_TTL, DNS_NEGATIVE_TTL)
+                break
+            except dns.exception.DNSException as e:
+                # Timeouts and server failures are not cached so the next invocation retries
+                logging.warning("DNS lookup failed for {}: {}".format(fqdn, e))
+                return None
+            ips = [x.address for x in answer]
+            ttl = answer.chaining_result.minimum_ttl if ttl is None else min(ttl, answer.chaining_result.minimum_ttl)
+            break
+        else:
+            logging.warning("DNS lookup failed for {}: CNAME chain longer than {}".format(fqdn, MAX_CNAME_DEPTH))
+            return None
+
+    dns_cache[fqdn] = {"ips": ips, "expires": time.time() + ttl}
+    return ips
+
+def filter_only_ipv4(ip_list):
+    # Filter out only the IPv4 addresses
+    ipv4_list = []
+    for x in ip_list:
+        try:
+            ipv4_list.append(str(ipaddress.IPv4Address(x)))
+        except ValueError:
+            logging.debug("Skipping non IPv4 answer: {}".format(x))
+    return ipv4_list
 
 def get_fqdn_smartgroups(controller_ip, cid):
-    # URL for the controller API
-    url = "https://{}/v2.5/api".format(controller_ip)
-    # Parameters to send for the GET request
-    headers = {
-        "Authorization": "cid {}".format(cid)
-    }
+    # Get the SmartGroups whose name starts with "fqdn_"
+    return get_app_domains_by_prefix(get_app_domains(controller_ip, cid), "fqdn_")
 
-    # Make a GET request to get current SmartGroups
-    response = requests.get("https://{}/v2.5/api/app-domains".format(
-        controller_ip), headers=headers, verify=False)
-    response = response.json()
-    
-    # Filter SmartGroups for when the name starts with "fqdn_"
-    fqdn_smartgroups = [x for x in response['app_domains'] if x["name"].startswith("fqdn_")]
-    return fqdn_smartgroups
+# Extract target FQDN from Smartgroup Name by removing fqdn_ prefix and replacing underscores with dots
+def get_smartgroup_fqdn(smartgroup):
+    return smartgroup["name"].replace("fqdn_", "").replace("_", ".")
 
 # Function to update the a Webgroup type SmartGroup by adding or removing a domain.  Input is a list of domains to add or remove.
-def update_fqdn_smartgroup_cidrs(controller_ip, smartgroup, cid):
+# The IPs of the FQDN are looked up unless they are passed in already resolved.
+def update_fqdn_smartgroup_cidrs(controller_ip, smartgroup, cid, cidrs=None):
     # URL for the controller API
     url = "https://{}/v2.5/api".format(controller_ip) 
     # Parameters to send for the GET request
@@ -90,24 +153,33 @@ def update_fqdn_smartgroup_cidrs(controller_ip, smartgroup, cid):
     ## EXAMPLE SMARTGROUP JSON
     # [{'uuid': '60477a53-72d0-4175-a3f6-5b861b77cfed', 'name': 'fqdn_www_google_com', 'selector': {'any': [{'all': {'cidr': '1.1.1.1'}}]}, 'system_resource': False}]
 
-    # Extract target FQDN from Smartgroup Name by removing fqdn_ prefix and replacing underscores with dots
-    fqdn = smartgroup["name"].replace("fqdn_", "").replace("_", ".")
+    fqdn = get_smartgroup_fqdn(smartgroup)
     logging.debug("FQDN: {}".format(fqdn))
 
     # Lookup the IPs for the FQDN
-    cidrs = lookup_fqdn_ip(fqdn)
+    if cidrs is None:
+        cidrs = lookup_fqdn_ip(fqdn)
     logging.debug("IP: {}".format(cidrs))
 
+    if cidrs is None:
+        return {"result": "Failed DNS lookup for {}".format(fqdn), "status": "failed"}
+
+    # Filter out ipv6 addresses and collapse the v4 CIDRs
+    cidrs = aggregate_cidrs(filter_only_ipv4(cidrs))
+
+    # Skip the update when the SmartGroup already matches the resolved CIDRs, every PUT is pushed to all gateways
+    if same_cidrs(get_selector_cidrs(smartgroup), cidrs):
+        logging.debug("SmartGroup {} unchanged".format(smartgroup["name"]))
+        return {"result": "Unchanged", "status": "unchanged"}
+
     # Format the new SmartGroup/WebGroup payload
     selector = []
     for cidr in cidrs:
-        # Filter out ipv6 addresses and add v4 addresses to the selector
-        if ":" not in cidr:
-            selector.append({
-                "all": {
-                    "cidr": cidr
-                }
-            })
+        selector.append({
+            "all": {
+                "cidr": cidr
+            }
+        })
     smartgroup_config = {
         "name": smartgroup["name"],
         "selector": {
@@ -118,11 +190,14 @@ def update_fqdn_smartgroup_cidrs(controller_ip, smartgroup, cid):
     logging.debug("SmartGroup Config: {}".format(json.dumps(smartgroup_config)))
 
     # Make a POST request to set the policies
-    response = requests.put("https://{}/v2.5/api/app-domains/{}".format(
+    acquire_controller_token()
+    response = get_controller_session().put("https://{}/v2.5/api/app-domains/{}".format(
         controller_ip, smartgroup["uuid"]), json=smartgroup_config, headers=headers, verify=False)
     
+    invalidate_app_domains(controller_ip)
+
     # Log the response
     logging.debug("Response to SmartGroup Update: {} {}".format(response.status_code,response.text))
 
     # Return the results and current filter list
-    return {"result": response.json()}
\ No newline at end of file
+    return {"result": response.json(), "status": "changed" if response.ok else "failed"}
\ No newline at end of file
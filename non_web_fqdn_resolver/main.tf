@@ -35,13 +35,6 @@ resource "aws_iam_role" "lambda_role" {
   })
 }
 
-# Create a Lambda Layer with lambda_layer_dig
-resource "aws_lambda_layer_version" "lambda_layer_dig" {
-  layer_name = "avx_lambda_layer_dig"
-  filename   = "${path.module}/lambda_layer_dig/dig-layer.zip"
-  compatible_runtimes = ["python3.10","python3.11","python3.12"]
-}
-
 # Create a Lambda function with a CloudWatch trigger every 5 minutes
 resource "aws_lambda_function" "fqdn_ip" {
   function_name = local.lambda_function_name
@@ -53,14 +46,15 @@ resource "aws_lambda_function" "fqdn_ip" {
 
   filename = "${path.module}/lambda_function/lambda_package.zip"
 
-  layers = [ aws_lambda_layer_version.lambda_layer_dig.arn ]
-
   environment {
     variables = {
       LOG_LEVEL = "INFO"
       AVIATRIX_CONTROLLER_IP = var.controller_ip
       AVIATRIX_USERNAME = var.controller_user
       AVIATRIX_PASSWORD = var.controller_password
+      DNS_CONCURRENCY = var.dns_concurrency
+      CONTROLLER_MAX_IN_FLIGHT = var.controller_max_in_flight
+      CONTROLLER_RATE_LIMIT = var.controller_rate_limit
     }
   }
 
@@ -0,0 +1,117 @@
+# Unit tests for the DNS resolution of the non-web FQDN resolver, against a local stub DNS server.
+# Run from the repository root with "python3 -m pytest non_web_fqdn_resolver/tests"
+import asyncio
+import importlib.util
+import os
+import socket
+import threading
+import time
+import unittest
+
+import dns.asyncresolver
+import dns.message
+import dns.rcode
+import dns.rrset
+
+FUNCTION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda_function", "function.py")
+spec = importlib.util.spec_from_file_location("fqdn_resolver_function", FUNCTION)
+function = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(function)
+
+# Records served by the stub, name -> (type, TTL, values).  A CNAME is answered alone, without the records it points
+# to, so the resolver has to follow the chain with another query.  Names not listed get NXDOMAIN, "timeout.test." is
+# never answered.
+ZONE = {
+    "a.test.": ("A", 300, ["192.0.2.1", "192.0.2.2"]),
+    "alias.test.": ("CNAME", 30, ["target.test."]),
+    "target.test.": ("A", 600, ["198.51.100.1"]),
+}
+
+# Start a stub DNS server on a free local port, returns the port and the list of names it was queried for
+def start_stub_dns_server():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    queries = []
+
+    def serve():
+        while True:
+            data, address = sock.recvfrom(4096)
+            query = dns.message.from_wire(data)
+            name = query.question[0].name.to_text()
+            queries.append(name)
+            if name == "timeout.test.":
+                continue
+            response = dns.message.make_response(query)
+            if name in ZONE:
+                rdtype, ttl, values = ZONE[name]
+                response.answer.append(dns.rrset.from_text(name, ttl, "IN", rdtype, *values))
+            else:
+                response.set_rcode(dns.rcode.NXDOMAIN)
+            sock.sendto(response.to_wire(), address)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return sock.getsockname()[1], queries
+
+
+class ResolveFqdnIpTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.port, cls.queries = start_stub_dns_server()
+
+    def setUp(self):
+        function.dns_cache.clear()
+        del self.queries[:]
+
+    def resolve(self, fqdn):
+        async def run():
+            resolver = dns.asyncresolver.Resolver(configure=False)
+            resolver.nameservers = ["127.0.0.1"]
+            resolver.port = self.port
+            return await function.resolve_fqdn_ip(resolver, asyncio.Semaphore(1), fqdn)
+        return asyncio.run(run())
+
+    def cached_ttl(self, fqdn):
+        return function.dns_cache[fqdn]["expires"] - time.time()
+
+    def test_a_record_is_cached_for_its_ttl(self):
+        self.assertEqual(sorted(self.resolve("a.test")), ["192.0.2.1", "192.0.2.2"])
+        self.assertAlmostEqual(self.cached_ttl("a.test"), 300, delta=5)
+
+        # Answered from the cache until the TTL expires
+        self.assertEqual(sorted(self.resolve("a.test")), ["192.0.2.1", "192.0.2.2"])
+        self.assertEqual(self.queries, ["a.test."])
+
+    def test_partial_cname_chain_is_followed(self):
+        self.assertEqual(self.resolve("alias.test"), ["198.51.100.1"])
+        self.assertEqual(self.queries, ["alias.test.", "target.test."])
+        # Cached for the lowest TTL in the chain
+        self.assertAlmostEqual(self.cached_ttl("alias.test"), 30, delta=5)
+
+    def test_nxdomain_is_cached_for_the_negative_ttl(self):
+        self.assertEqual(self.resolve("missing.test"), [])
+        self.assertAlmostEqual(self.cached_ttl("missing.test"), function.DNS_NEGATIVE_TTL, delta=5)
+
+        self.assertEqual(self.resolve("missing.test"), [])
+        self.assertEqual(self.queries, ["missing.test."])
+
+    def test_timeout_returns_none_and_is_not_cached(self):
+        timeout = function.DNS_TIMEOUT
+        function.DNS_TIMEOUT = 0.2
+        try:
+            self.assertIsNone(self.resolve("timeout.test"))
+        finally:
+            function.DNS_TIMEOUT = timeout
+        self.assertNotIn("timeout.test", function.dns_cache)
+
+    def test_expired_answer_is_resolved_again(self):
+        self.resolve("alias.test")
+        function.dns_cache["alias.test"]["expires"] = time.time() - 1
+        del self.queries[:]
+
+        self.assertEqual(self.resolve("alias.test"), ["198.51.100.1"])
+        self.assertEqual(self.queries, ["alias.test.", "target.test."])
+        self.assertAlmostEqual(self.cached_ttl("alias.test"), 30, delta=5)
+
+
+if __name__ == "__main__":
+    unittest.main()
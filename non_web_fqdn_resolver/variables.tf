@@ -22,4 +22,16 @@ variable "timeout" {
 variable "frequency_minutes" {
   default = 5
   
-}
\ No newline at end of file
+}
+
+variable "dns_concurrency" {
+  default = 20
+}
+
+variable "controller_max_in_flight" {
+  default = 8
+}
+
+variable "controller_rate_limit" {
+  default = 10
+}
@@ -1,13 +1,20 @@
 # Import necessary libraries
 import json
 import os
-import requests
+import sys
+import time
 import logging
+import hashlib
+import random
 
 # Disable certificate warnings
 import urllib3
 urllib3.disable_warnings()
 
+# Shared controller API client, imported from the repository root one level up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from aviatrix_client import login, get_controller_session
+
 logging.basicConfig(level=logging.DEBUG)
 
 
@@ -26,6 +33,7 @@ def handler(event, context):
 
     # Sanitize accepted inputs
     action = body["action"]
+    result = None
     if action == "ADD_RULE":
         new_policy_list = None
         rule_uuid = None
@@ -40,12 +48,23 @@ def handler(event, context):
         rule = body["rule"]
     elif action == "REPLACE_LIST":
         new_policy_list = body["policy_list"]
-        priority = None
+        rule_uuid = None
+        rule = None
+    elif action == "EDIT_RULES":
+        new_policy_list = None
+        rule_uuid = None
         rule = None
+        if not isinstance(body.get("operations"), list):
+            result = {"result": "Failed Invalid Action - EDIT_RULES requires a list of operations"}
+    else:
+        result = {"result": "Failed Invalid Action - supports ADD_RULE, DELETE_RULE, REPLACE_RULE, REPLACE_LIST, EDIT_RULES"}
 
     # Call the function to update the IP with necessary parameters
-    result = update_policy_list(controller_ip=os.getenv("CONTROLLER_IP"), cid=cid,
-                                action=action, new_policy_list=new_policy_list, rule_uuid=rule_uuid, rule=rule)
+    if result is None:
+        result = update_policy_list(controller_ip=os.getenv("CONTROLLER_IP"), cid=cid,
+                                    action=action, new_policy_list=new_policy_list, rule_uuid=rule_uuid, rule=rule,
+                                    operations=body.get("operations"), optimistic=body.get("optimistic", False),
+                                    fingerprint=body.get("fingerprint"))
 
     # Format and return the response
     response = {
@@ -58,28 +77,17 @@ def handler(event, context):
 
     return response
 
-# Function to login to the controller
-
-
-def login(controller_ip, controller_user, controller_password):
-    # URL for the controller API
-    url = "https://{}/v2/api".format(controller_ip)
-    # Payload to send for login
-    payload = {'action': 'login',
-               'username': controller_user,
-               'password': controller_password}
-
-    headers = {}
-
-    # Make a POST request to the URL with the payload
-    response = requests.post(url, headers=headers, data=payload, verify=False)
-
-    # Return the CID from the response
-    return response.json()["CID"]
-
+# Optimistic concurrency for rule edits - the number of times a write is rebased onto a changed policy list before giving
+# up, and how long to wait before checking that a write was not overwritten.  The wait should exceed the time another
+# writer takes from reading the list to writing it, so any write based on the list before ours has landed by then.
+POLICY_WRITE_ATTEMPTS = int(os.getenv("POLICY_WRITE_ATTEMPTS", "5"))
+POLICY_WRITE_SETTLE = float(os.getenv("POLICY_WRITE_SETTLE", "1.0"))
 
 # Function to update the a Webgroup type SmartGroup by adding or removing a domain.  Input is a list of domains to add or remove.
-def update_policy_list(controller_ip, cid, action, rule=None, new_policy_list=None, rule_uuid=None):
+# With optimistic set, rule edits are only written if the policy list is unchanged since it was read, otherwise they
+# are rebased onto the new list and retried.  fingerprint, from an earlier result, makes the write fail if the list changed since.
+def update_policy_list(controller_ip, cid, action, rule=None, new_policy_list=None, rule_uuid=None, operations=None,
+                       optimistic=False, fingerprint=None):
     # URL for the controller API
     url = "https://{}/v2.5/api".format(controller_ip)
     # Parameters to send for the GET request
@@ -90,52 +98,80 @@ def update_policy_list(controller_ip, cid, action, rule=None, new_policy_list=No
     # Log the cid
     logging.debug("Headers: {}".format(headers))
 
-    # Make a GET request to get current SmartGroups
-    response = requests.get("https://{}/v2.5/api/microseg/policy-list".format(
-        controller_ip), headers=headers, verify=False)
-    logging.debug("Response for Existing Policy List: {} {}".format(
-        response.status_code, response.text))
-    response = response.json()
-
     # Extract current rules from policy list Smartgroup
-    policies = response['policies']
+    policies = get_policy_list(controller_ip, headers)
     logging.debug("Existing Policies: {}".format(policies))
 
-    # current_cidrs = [x["all"]["cidr"]
-    #                    for x in smartgroup["selector"]["any"]]
+    if fingerprint and fingerprint != fingerprint_policies(policies):
+        return {"result": "Failed Conflict - policy list changed since fingerprint {}".format(fingerprint)}
 
-    # Depending on the action, calculate the new configured policies
+    # Depending on the action, calculate the new configured policies.  Single rule actions are applied as a list of one edit.
     if action == "ADD_RULE":
         logging.debug("NEW RULE: {}".format(json.dumps(rule)))
-        new_policy_config = policies + [rule]
+        operations = [{"action": action, "rule": rule}]
     elif action == "DELETE_RULE":
-        new_policy_config = [
-            x for x in policies if x['uuid'] != rule_uuid]
+        operations = [{"action": action, "rule_uuid": rule_uuid}]
     elif action == "REPLACE_RULE":
-        rule_uuid = rule["uuid"]
-        new_policy_config = [
-            x for x in policies if x['uuid'] != rule_uuid]
-        new_policy_config.append(rule)
+        operations = [{"action": action, "rule_uuid": rule_uuid, "rule": rule}]
     elif action == "REPLACE_LIST":
-        new_policy_config = new_policy_list
-    else:
-        return {"result": "Failed Invalid Action - supports ADD_RULE, DELETE_RULE, REPLACE_RULE, REPLACE_LIST"}
-
-    logging.debug("New Configured Policies: {}".format(json.dumps(new_policy_config)))
-
-    # Format the new policy list payload
-    if action != "REPLACE_LIST":
-        payload = {
-            "policies": new_policy_config
-        }     
-    else:
-        payload = new_policy_config
+        return put_policy_list(controller_ip, headers, new_policy_list)
+    elif action != "EDIT_RULES":
+        return {"result": "Failed Invalid Action - supports ADD_RULE, DELETE_RULE, REPLACE_RULE, REPLACE_LIST, EDIT_RULES"}
+
+    for attempt in range(POLICY_WRITE_ATTEMPTS if optimistic else 1):
+        if attempt > 0:
+            # Back off with jitter so concurrent writers do not rebase in lockstep
+            time.sleep(random.uniform(0, 0.25 * 2 ** attempt))
+            policies = get_policy_list(controller_ip, headers)
+
+        # Apply the rule edits to the fetched list, nothing is sent when any edit fails the pre-flight checks
+        try:
+            new_policy_config = apply_policy_edits(policies, operations)
+        except ValueError as e:
+            return {"result": "Failed {}".format(e)}
+
+        logging.debug("New Configured Policies: {}".format(json.dumps(new_policy_config)))
+
+        if optimistic:
+            # Compare the fingerprint of the list as read with the list right before the write
+            current = get_policy_list(controller_ip, headers)
+            if fingerprint_policies(current) != fingerprint_policies(policies):
+                logging.info("Policy list changed since it was read, rebasing {} edits".format(len(operations)))
+                continue
+
+        result = put_policy_list(controller_ip, headers, {"policies": new_policy_config})
+
+        # A rejected write is returned as is, only a write that went through can have been overwritten
+        if result["status"] == "failed":
+            return result
+
+        if optimistic:
+            # The controller has no conditional write, so check that a concurrent write did not replace ours
+            time.sleep(POLICY_WRITE_SETTLE)
+            written = get_policy_list(controller_ip, headers)
+            if not policy_edits_applied(written, operations):
+                logging.info("Policy edits were overwritten by a concurrent write, rebasing {} edits".format(len(operations)))
+                continue
+            result["fingerprint"] = fingerprint_policies(written)
+        return result
+
+    return {"result": "Failed Conflict - policy list kept changing after {} attempts".format(POLICY_WRITE_ATTEMPTS)}
+
+def get_policy_list(controller_ip, headers):
+    # Make a GET request to get current SmartGroups
+    response = get_controller_session().get("https://{}/v2.5/api/microseg/policy-list".format(
+        controller_ip), headers=headers, verify=False)
+    logging.debug("Response for Existing Policy List: {} {}".format(
+        response.status_code, response.text))
+    response = response.json()
+    return response['policies']
 
+def put_policy_list(controller_ip, headers, payload):
     logging.debug("New Policy Config: {}".format(
         json.dumps(payload)))
 
     # Make a POST request to set the policies
-    response = requests.put("https://{}/v2.5/api/microseg/policy-list".format(
+    response = get_controller_session().put("https://{}/v2.5/api/microseg/policy-list".format(
         controller_ip), json=payload, headers=headers, verify=False)
 
     # Log the response
@@ -143,7 +179,91 @@ def update_policy_list(controller_ip, cid, action, rule=None, new_policy_list=No
         response.status_code, response.text))
 
     # Return the results and current filter list
-    return {"result": response.json()}
+    return {"result": response.json(), "status": "changed" if response.ok else "failed"}
+
+# Fingerprint of a policy list, independent of key order in the rules
+def fingerprint_policies(policies):
+    return hashlib.sha256(json.dumps(policies, sort_keys=True).encode()).hexdigest()
+
+# Check that a policy list reflects the final state of every rule touched by a list of edits.  Rules are matched by UUID,
+# or by name for rules added without one, and compared on name, priority and action as the controller fills in the rest.
+def policy_edits_applied(policies, operations):
+    expected = {}
+    for operation in operations:
+        if operation["action"] == "DELETE_RULE":
+            expected[operation["rule_uuid"]] = None
+        else:
+            rule = operation["rule"]
+            expected[rule.get("uuid") or operation.get("rule_uuid") or ("name", rule.get("name"))] = rule
+
+    by_key = {}
+    for policy in policies:
+        by_key[policy.get("uuid")] = policy
+        by_key.setdefault(("name", policy.get("name")), policy)
+
+    for key, rule in expected.items():
+        if rule is None:
+            if key in by_key:
+                return False
+        elif key not in by_key or any(by_key[key].get(x) != rule.get(x) for x in ["name", "priority", "action"]):
+            return False
+    return True
+
+
+# Function to apply an ordered list of ADD_RULE/DELETE_RULE/REPLACE_RULE edits to a policy list.  Rules are looked up
+# through a UUID index and a priority index instead of rebuilding the list per edit.  Raises ValueError for an edit
+# that references an unknown rule, adds a duplicate UUID or takes the priority of another rule.
+def apply_policy_edits(policies, operations):
+    # Rules by UUID in list order, rules added without a UUID get a placeholder key until the controller assigns one
+    rules = {}
+    for index, policy in enumerate(policies):
+        rules[policy.get("uuid") or ("new", index)] = policy
+    # Keys of the rules holding each priority
+    priorities = {}
+    for key, policy in rules.items():
+        priorities.setdefault(policy.get("priority"), set()).add(key)
+
+    def check_priority(policy, key, index):
+        holders = priorities.get(policy.get("priority"), set()) - set([key])
+        if holders:
+            raise ValueError("Priority Collision - edit {} priority {} is used by rule {}".format(
+                index, policy.get("priority"), rules[next(iter(holders))].get("name")))
+
+    def remove_rule(key):
+        priorities[rules[key].get("priority")].discard(key)
+        del rules[key]
+
+    def add_rule(key, policy):
+        rules[key] = policy
+        priorities.setdefault(policy.get("priority"), set()).add(key)
+
+    for index, operation in enumerate(operations):
+        action = operation.get("action")
+        if action == "ADD_RULE":
+            rule = operation["rule"]
+            key = rule.get("uuid") or ("new", len(policies) + index)
+            if key in rules:
+                raise ValueError("Duplicate Rule UUID - edit {} adds existing rule {}".format(index, key))
+            check_priority(rule, key, index)
+            add_rule(key, rule)
+        elif action == "DELETE_RULE":
+            if operation["rule_uuid"] not in rules:
+                raise ValueError("Unknown Rule UUID - edit {} deletes rule {}".format(index, operation["rule_uuid"]))
+            remove_rule(operation["rule_uuid"])
+        elif action == "REPLACE_RULE":
+            rule = operation["rule"]
+            key = rule.get("uuid") or operation.get("rule_uuid")
+            if key not in rules:
+                raise ValueError("Unknown Rule UUID - edit {} replaces rule {}".format(index, key))
+            check_priority(rule, key, index)
+            # Replace in place, keeping the position of the rule in the list.  The rule keeps its UUID so the
+            # controller replaces it rather than adding a new rule.
+            priorities[rules[key].get("priority")].discard(key)
+            add_rule(key, dict(rule, uuid=key))
+        else:
+            raise ValueError("Invalid Action - edit {} supports ADD_RULE, DELETE_RULE, REPLACE_RULE".format(index))
+
+    return list(rules.values())
 
 
 # Test execution to add "aviatrix.com" to the WebGroup - replace SmartGroup UUID and Domains for testing
@@ -203,6 +323,14 @@ test_body_replace_rule = {"action": "REPLACE_RULE",
 
 test_body_delete_rule = {"action": "DELETE_RULE", "rule_uuid":"ef6f3d49-b42a-442c-9d05-093b0f1903b1"}
 
+# With "optimistic": true the edits are rebased and retried when another writer changes the policy list concurrently
+test_body_edit_rules = {"action": "EDIT_RULES",
+                        "optimistic": True,
+                        "operations": [
+                            {"action": "DELETE_RULE", "rule_uuid": "ef6f3d49-b42a-442c-9d05-093b0f1903b1"},
+                            {"action": "ADD_RULE", "rule": test_body_add_rule["rule"]}
+                        ]}
+
 ## UNCOMMENT TO TEST SPECIFIC CASES
 ## ADD A RULE
 # print(handler(
@@ -214,4 +342,8 @@ test_body_delete_rule = {"action": "DELETE_RULE", "rule_uuid":"ef6f3d49-b42a-442
 
 ## DELETE A RULE - MAKE SURE THE PAYLOAD INCLUDES THE CORRECT RULE UUID - CAN BE GLEANED FROM THE OUTPUT OF THE ADD_RULE ACTION
 # print(handler(
-#     {"body": json.dumps(test_body_delete_rule)}, None))
\ No newline at end of file
+#     {"body": json.dumps(test_body_delete_rule)}, None))
+
+## APPLY SEVERAL RULE EDITS WITH ONE FETCH AND ONE PUT - EDITS ARE APPLIED IN ORDER AND NOTHING IS SENT IF ANY EDIT FAILS
+# print(handler(
+#     {"body": json.dumps(test_body_edit_rules)}, None))
\ No newline at end of file
@@ -1,20 +1,27 @@
 # Import necessary libraries
 import json
 import os
-import requests
+import sys
 import logging
 
 # Disable certificate warnings
 import urllib3
 urllib3.disable_warnings()
 
+# Shared controller API client, imported from the repository root one level up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from aviatrix_client import login, get_controller_session, acquire_controller_token, run_concurrent_updates, \
+    get_app_domains, invalidate_app_domains, aggregate_cidrs, remove_cidrs
+
 logging.basicConfig(level=logging.INFO)
 
 
 # Main event handler function
 def handler(event, context):
-    # Parse the body from the event
+    # Parse the body from the event.  A batch lists several {smartgroup_uuid, action, domains} operations, a single
+    # operation is handled as a batch of one and answered with its own result.
     body = json.loads(event['body'])
+    operations = body["operations"] if "operations" in body else [body]
 
     # Login to the controller and get the CID
     cid = login(os.getenv("CONTROLLER_IP"), os.getenv(
@@ -23,9 +30,9 @@ def handler(event, context):
     # Log the cid
     logging.debug("CID: {}".format(cid))
 
-    # Call the function to update the IP with necessary parameters
-    result = update_smartgroup_cidrs(os.getenv("CONTROLLER_IP"),
-                                     body["smartgroup_uuid"], body["domains"], cid, body["action"])
+    # Call the function to update the IPs with necessary parameters
+    results = update_smartgroups_cidrs(os.getenv("CONTROLLER_IP"), operations, cid)
+    result = results if "operations" in body else results[0]
 
     # Format and return the response
     response = {
@@ -38,28 +45,15 @@ def handler(event, context):
 
     return response
 
-# Function to login to the controller
-
-
-def login(controller_ip, controller_user, controller_password):
-    # URL for the controller API
-    url = "https://{}/v2/api".format(controller_ip)
-    # Payload to send for login
-    payload = {'action': 'login',
-               'username': controller_user,
-               'password': controller_password}
-
-    headers = {}
-
-    # Make a POST request to the URL with the payload
-    response = requests.post(url, headers=headers, data=payload, verify=False)
-
-    # Return the CID from the response
-    return response.json()["CID"]
-
-
 # Function to update the a Webgroup type SmartGroup by adding or removing a domain.  Input is a list of domains to add or remove.
 def update_smartgroup_cidrs(controller_ip, smartgroup_uuid, cidrs, cid, action):
+    return update_smartgroups_cidrs(controller_ip, [{"smartgroup_uuid": smartgroup_uuid, "domains": cidrs,
+                                                     "action": action}], cid)[0]
+
+# Function to apply a batch of ADD/DELETE operations to SmartGroups.  The SmartGroups are listed once, the operations on
+# each SmartGroup are applied in order and coalesced into a single PUT, and the PUTs run concurrently.  Returns the
+# result of every operation in the order of the operations.
+def update_smartgroups_cidrs(controller_ip, operations, cid):
     # URL for the controller API
     url = "https://{}/v2.5/api".format(controller_ip) 
     # Parameters to send for the GET request
@@ -70,58 +64,82 @@ def update_smartgroup_cidrs(controller_ip, smartgroup_uuid, cidrs, cid, action):
     # Log the cid
     logging.debug("Headers: {}".format(headers))
 
-    # Make a GET request to get current SmartGroups
-    response = requests.get("https://{}/v2.5/api/app-domains".format(
-        controller_ip), headers=headers, verify=False)
-    logging.debug("Response for Existing SmartGroups: {} {}".format(response.status_code,response.text))
-    response = response.json()
-
-    # Extract current domains from target Smartgroup
-    smartgroup = [x for x in response['app_domains']
-                  if x["uuid"] == smartgroup_uuid]
-    if len(smartgroup) > 0:
-        smartgroup = smartgroup[0]
-    else:
-        logging.info("Current SmartGroups: {}".format(json.dumps(response)))
-        return {"result": "Invalid SmartGroup UUID"}
-
-    current_cidrs = [x["all"]["cidr"]
-                       for x in smartgroup["selector"]["any"]]
-
-    # Depending on the action, calculate the new configured policies
-    if action == "ADD":
-        new_configured_policies = list(set(current_cidrs) | set(cidrs))
-    elif action == "DELETE":
-        new_configured_policies = list(set(current_cidrs) - set(cidrs))
-    else:
-        return {"result": "Failed Invalid Action - supports ADD or DELETE"}
-
-    # Format the new SmartGroup/WebGroup payload
-    selector = []
-    for cidr in new_configured_policies:
-        selector.append({
-            "all": {
-                "cidr": cidr
+    # Get the current SmartGroups indexed by UUID
+    snapshot = get_app_domains(controller_ip, cid, fresh=True)
+    smartgroups = snapshot["by_uuid"]
+
+    # Calculate the new CIDRs of each target SmartGroup, starting from its current CIDRs
+    results = [None] * len(operations)
+    updates = {}
+    for index, operation in enumerate(operations):
+        # A missing key or a malformed operation or selector only fails this operation
+        try:
+            smartgroup = smartgroups.get(operation["smartgroup_uuid"])
+            if smartgroup is None:
+                logging.info("Current SmartGroups: {}".format(json.dumps(snapshot["app_domains"])))
+                results[index] = {"result": "Invalid SmartGroup UUID", "status": "failed"}
+                continue
+            if operation["action"] not in ("ADD", "DELETE"):
+                results[index] = {"result": "Failed Invalid Action - supports ADD or DELETE", "status": "failed"}
+                continue
+
+            update = updates.setdefault(smartgroup["uuid"], {
+                "smartgroup": smartgroup,
+                "cidrs": [x["all"]["cidr"] for x in smartgroup["selector"]["any"]],
+                "operations": []
+            })
+
+            # Depending on the action, calculate the new configured policies.  The result is collapsed into the
+            # smallest equivalent list of CIDRs so the SmartGroup selector stays small.
+            if operation["action"] == "ADD":
+                update["cidrs"] = aggregate_cidrs(update["cidrs"] + operation["domains"])
+            else:
+                update["cidrs"] = remove_cidrs(update["cidrs"], operation["domains"])
+            update["operations"].append(index)
+        except ValueError as e:
+            results[index] = {"result": "Failed Invalid CIDR - {}".format(e), "status": "failed"}
+        except (KeyError, TypeError) as e:
+            results[index] = {"result": "Failed Invalid Operation - {}: {}".format(type(e).__name__, e), "status": "failed"}
+
+    # Drop SmartGroups whose operations all failed
+    updates = [x for x in updates.values() if x["operations"]]
+
+    def put_smartgroup(update):
+        # Format the new SmartGroup/WebGroup payload
+        selector = []
+        for cidr in update["cidrs"]:
+            selector.append({
+                "all": {
+                    "cidr": cidr
+                }
+            })
+        smartgroup_config = {
+            "name": update["smartgroup"]["name"],
+            "selector": {
+                "any": selector
             }
-        })
-    smartgroup_config = {
-        "name": smartgroup["name"],
-        "selector": {
-            "any": selector
         }
-    }
 
-    logging.debug("SmartGroup Config: {}".format(json.dumps(smartgroup_config)))
+        logging.debug("SmartGroup Config: {}".format(json.dumps(smartgroup_config)))
 
-    # Make a POST request to set the policies
-    response = requests.put("https://{}/v2.5/api/app-domains/{}".format(
-        controller_ip, smartgroup_uuid), json=smartgroup_config, headers=headers, verify=False)
-    
-    # Log the response
-    logging.debug("Response to SmartGroup Update: {} {}".format(response.status_code,response.text))
+        # Make a POST request to set the policies
+        acquire_controller_token()
+        response = get_controller_session().put("https://{}/v2.5/api/app-domains/{}".format(
+            controller_ip, update["smartgroup"]["uuid"]), json=smartgroup_config, headers=headers, verify=False)
 
-    # Return the results and current filter list
-    return {"result": response.json()}
+        invalidate_app_domains(controller_ip)
+
+        # Log the response
+        logging.debug("Response to SmartGroup Update: {} {}".format(response.status_code,response.text))
+        return {"result": response.json(), "status": "changed" if response.ok else "failed"}
+
+    # Make one PUT per SmartGroup, paced by the controller rate limiter.  A failed PUT only fails the operations on
+    # its SmartGroup, the other PUTs still go through.
+    for update, result in zip(updates, run_concurrent_updates(put_smartgroup, updates)):
+        # Return the results and current filter list
+        for index in update["operations"]:
+            results[index] = result
+    return results
 
 
 # Test execution to add "aviatrix.com" to the WebGroup - replace SmartGroup UUID and Domains for testing
@@ -129,5 +147,9 @@ test_body = {"smartgroup_uuid": "6ab5ee9a-6e59-4552-81dd-522804a086e4",
              "domains": ["10.0.0.0/8"],
              "action": "ADD"}
 
+# A batch of operations is sent as {"operations": [...]}, for example
+# test_body = {"operations": [{"smartgroup_uuid": "6ab5ee9a-6e59-4552-81dd-522804a086e4", "domains": ["10.0.0.0/8"], "action": "ADD"},
+#                             {"smartgroup_uuid": "6ab5ee9a-6e59-4552-81dd-522804a086e4", "domains": ["10.0.0.0/8"], "action": "DELETE"}]}
+
 print(handler(
     {"body": json.dumps(test_body)}, None))